@@ -1,47 +1,46 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context, g
 from flask_cors import CORS
 import json
+import asyncio
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import PyPDF2
 from io import BytesIO
+from urllib.parse import urlparse
 import os
 import uuid
+import hashlib
+import sqlite3
+import socket
 import random
 import re
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
 import copy
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor
 import time
-from collections import defaultdict
+import heapq
+import bisect
+import functools
+import inspect
+import itertools
+import math
+from collections import defaultdict, deque, OrderedDict
+from flask.json.provider import DefaultJSONProvider
 
-load_dotenv()
-
-# Thread pool for background batch generation (conservative worker count)
-executor = ThreadPoolExecutor(max_workers=4)  # Reduced for better resource management
+try:
+    import orjson  # Optional: faster JSON encoding and decoding
+except ImportError:
+    orjson = None
 
-# Simple rate limiting for session creation
-session_creation_times = defaultdict(list)
-MAX_SESSIONS_PER_MINUTE = 5  # Limit sessions per IP per minute
-
-def check_rate_limit(client_ip):
-    """Check if client is within rate limits for session creation"""
-    current_time = time.time()
-    minute_ago = current_time - 60
-    
-    # Clean old entries
-    session_creation_times[client_ip] = [
-        t for t in session_creation_times[client_ip] if t > minute_ago
-    ]
-    
-    # Check if under limit
-    if len(session_creation_times[client_ip]) >= MAX_SESSIONS_PER_MINUTE:
-        return False
-    
-    # Record this request
-    session_creation_times[client_ip].append(current_time)
-    return True
+load_dotenv()
 
 # Configure logging
 logging.basicConfig(
@@ -60,10 +59,67 @@ CORS(app, origins=['http://localhost:3000', 'http://localhost:8080', 'http://127
 class Config:
     OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
     OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-2024-05-13')  # Configurable model with reliable default
-    OPENAI_API_URL = "https://api.openai.com/v1/chat/completions"
+    OPENAI_API_URL = os.getenv('OPENAI_API_URL', "https://api.openai.com/v1/chat/completions")
+    OPENAI_POOL_SIZE = int(os.getenv('OPENAI_POOL_SIZE', '16'))  # Max keep-alive connections to the API host
+    OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', '5'))
+    OPENAI_READ_TIMEOUT = float(os.getenv('OPENAI_READ_TIMEOUT', '60'))
+    ASYNC_MAX_IN_FLIGHT = int(os.getenv('ASYNC_MAX_IN_FLIGHT', '256'))  # Concurrent calls on the event loop
+    PROMPT_VERSION = "4.1-1"  # Bump whenever a generation prompt changes to invalidate cached output
+    CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memory')  # memory, sqlite or none
+    CACHE_PATH = os.getenv('CACHE_PATH', 'alp3_cache.sqlite3')
+    CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+    CACHE_TTL_SECONDS = int(os.getenv('CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+    PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', 'False').lower() == 'true'  # Speculative spend; opt in
+    PREFETCH_TOP_N = int(os.getenv('PREFETCH_TOP_N', '10'))  # Popular topics kept warm
+    PREFETCH_MIN_REQUESTS = int(os.getenv('PREFETCH_MIN_REQUESTS', '3'))  # Requests a topic needs before it is warmed
+    PREFETCH_POOL_DEPTH = int(os.getenv('PREFETCH_POOL_DEPTH', '2'))  # Ready entries per topic
+    PREFETCH_MAX_AGE_SECONDS = int(os.getenv('PREFETCH_MAX_AGE_SECONDS', '3600'))
+    PREFETCH_REFILLS_PER_MINUTE = float(os.getenv('PREFETCH_REFILLS_PER_MINUTE', '6'))
+    PREFETCH_TOKEN_BUDGET_PER_HOUR = int(os.getenv('PREFETCH_TOKEN_BUDGET_PER_HOUR', '200000'))
+    PREFETCH_TOKENS_PER_ENTRY = int(os.getenv('PREFETCH_TOKENS_PER_ENTRY', '6000'))  # Estimate for plan + batch 0
     DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
-    SESSION_TIMEOUT_HOURS = 24
+    PDF_MAX_DOCUMENT_CHARS = int(os.getenv('PDF_MAX_DOCUMENT_CHARS', '400000'))  # Upper bound on text kept per upload
+    PDF_CHUNK_CHARS = 1200            # Target size of one document chunk
+    PDF_OUTLINE_SECTIONS = 12         # Sections summarized in the study plan prompt
+    PDF_PLAN_CONTEXT_CHARS = 4000     # Document context budget for the study plan prompt
+    PDF_CONCEPT_CHUNKS = 2            # Chunks retrieved per concept for question prompts
+    PDF_BATCH_CONTEXT_CHARS = 6000    # Document context budget for one batch prompt
+    PDF_EXTRACT_WORKERS = int(os.getenv('PDF_EXTRACT_WORKERS', '0'))  # >1 enables process-pool extraction
+    PDF_PAGES_PER_WORKER_TASK = int(os.getenv('PDF_PAGES_PER_WORKER_TASK', '16'))
+    SESSION_TIMEOUT_HOURS = 24  # Measured from the session's last activity
+    SESSION_REAP_INTERVAL_SECONDS = int(os.getenv('SESSION_REAP_INTERVAL_SECONDS', '60'))
+    SESSION_STORE = os.getenv('SESSION_STORE', 'memory')  # memory, sqlite or redis
+    SESSION_STORE_PATH = os.getenv('SESSION_STORE_PATH', 'alp3_sessions.sqlite3')
+    SESSION_STORE_URL = os.getenv('SESSION_STORE_URL', 'redis://localhost:6379/0')
+    
+    # Rate limiting: "<route>=<requests>/<seconds>" per client address, comma separated
+    RATE_LIMITS = os.getenv('RATE_LIMITS', 'session_create=5/60,answer=120/60,next_question=120/60')
+    RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')  # memory (per process) or redis (shared)
+    RATE_LIMIT_URL = os.getenv('RATE_LIMIT_URL', os.getenv('SESSION_STORE_URL', 'redis://localhost:6379/0'))
+    RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', '100000'))  # Memory backend: LRU bound
+    BATCH_LOOKAHEAD_QUESTIONS = int(os.getenv('BATCH_LOOKAHEAD_QUESTIONS', '3'))  # Minimum ready questions ahead
+    BATCH_CLAIM_TIMEOUT_SECONDS = 120  # A claimed batch that never arrived may be claimed again
+    NEXT_QUESTION_LONG_POLL_SECONDS = 25  # Longest a /api/next-question request is held open
+    NEXT_QUESTION_RECHECK_SECONDS = 1.0  # Waiters re-check the store for questions added by other workers
+    MASTERY_BATCH_WINDOW_SECONDS = float(os.getenv('MASTERY_BATCH_WINDOW_SECONDS', '8'))  # Wrong answers collected per call
+    MASTERY_BATCH_MAX_CONCEPTS = int(os.getenv('MASTERY_BATCH_MAX_CONCEPTS', '2'))  # Keep within MAX_TOKENS_CEILING
+    SESSION_TOKEN_BUDGET = int(os.getenv('SESSION_TOKEN_BUDGET', '150000'))  # Prompt + completion tokens; 0 disables
+    MAX_TOKENS_CEILING = int(os.getenv('MAX_TOKENS_CEILING', '4096'))
+    MAX_TOKENS_FLOOR = 512
+    MAX_TOKENS_HEADROOM = 1.25      # Multiplier over the largest recent completion
+    MAX_TOKENS_MIN_SAMPLES = 20     # Observations needed before max_tokens adapts
+    MAX_TOKENS_WINDOW = 200         # Recent completions remembered per call type
+    LLM_RETRY_BASE_SECONDS = float(os.getenv('LLM_RETRY_BASE_SECONDS', '0.5'))
+    LLM_RETRY_MAX_SECONDS = float(os.getenv('LLM_RETRY_MAX_SECONDS', '20'))
+    BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))  # Consecutive failures that open it
+    BREAKER_COOLDOWN_SECONDS = float(os.getenv('BREAKER_COOLDOWN_SECONDS', '30'))
+    LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '32'))  # Calls in flight across all lanes
+    LLM_FOREGROUND_RESERVED_SLOTS = int(os.getenv('LLM_FOREGROUND_RESERVED_SLOTS', '4'))  # Never used by background lanes
+    LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', '0'))  # Account TPM limit; 0 disables
+    LLM_SECONDS_PER_QUESTION = 20   # Default time a student spends per question, until their pace is measured
+    JSON_CODEC = os.getenv('JSON_CODEC', 'auto')  # auto (orjson when installed), orjson or stdlib
+    QUESTION_JSON_CACHE_SIZE = int(os.getenv('QUESTION_JSON_CACHE_SIZE', '4096'))  # Serialized questions kept
 
 # Validate required environment variables
 if not Config.OPENAI_API_KEY:
@@ -73,9 +129,6 @@ if not Config.OPENAI_API_KEY:
 # Set Flask configuration
 app.config['MAX_CONTENT_LENGTH'] = Config.MAX_CONTENT_LENGTH
 
-# Global session storage (in production, use Redis or database)
-sessions = {}
-
 # Custom exceptions
 class APIError(Exception):
     def __init__(self, message, status_code=500):
@@ -110,12 +163,18 @@ def validate_session_data(data):
 
 def validate_answer_data(data):
     """Validate answer submission data"""
-    required_fields = ['session_id', 'selected_answer', 'current_question']
+    if not data:
+        raise ValidationError('No data provided')
+    
+    required_fields = ['session_id', 'selected_answer', 'question_id']
     
     for field in required_fields:
         if not data.get(field):
             raise ValidationError(f'{field} is required')
     
+    if not isinstance(data.get('question_id'), int):
+        raise ValidationError('question_id must be an integer')
+    
     selected_answer = data.get('selected_answer')
     if selected_answer.upper() not in ['A', 'B', 'C', 'D']:
         raise ValidationError('Selected answer must be A, B, C, or D')
@@ -131,6 +190,8 @@ def sanitize_input(text):
     text = re.sub(r'[<>"\']', '', text)
     return text.strip()
 
+OPTION_KEYS = 'ABCD'
+
 def normalize_option_keys(question):
     """Normalize option keys to uppercase and ensure all A,B,C,D exist"""
     if 'options' not in question:
@@ -151,188 +212,2574 @@ def normalize_option_keys(question):
         if opt not in normalized_options:
             normalized_options[opt] = f"Option {opt}"
     
-    question['options'] = normalized_options
+    question['options'] = normalized_options
+    
+    # Normalize correct_answer
+    if 'correct_answer' in question:
+        question['correct_answer'] = question['correct_answer'].upper()
+    
+    return question
+
+def shuffled_option_order():
+    """Random display order for a question's options, e.g. 'CADB'"""
+    return ''.join(random.sample(OPTION_KEYS, len(OPTION_KEYS)))
+
+def displayed_options(question):
+    """Options keyed by the letters the student sees; option_order[i] is the key shown as OPTION_KEYS[i]"""
+    options = question['options']
+    order = question.get('option_order', OPTION_KEYS)
+    return {shown: options[key] for shown, key in zip(OPTION_KEYS, order)}
+
+def canonical_option(question, shown):
+    """Map a displayed letter back to the stored option key"""
+    index = OPTION_KEYS.find(shown)
+    if len(shown) != 1 or index < 0:
+        return shown
+    return question.get('option_order', OPTION_KEYS)[index]
+
+def displayed_option(question, key):
+    """The letter a stored option key is displayed under"""
+    return OPTION_KEYS[question.get('option_order', OPTION_KEYS).index(key)]
+
+# ------------------------------------------------------------------
+#  JSON CODEC: orjson when installed, stdlib json otherwise
+# ------------------------------------------------------------------
+class JSONFragment:
+    """A JSON object serialized ahead of time; `extra` keys are merged in when it is encoded"""
+    __slots__ = ('raw', 'extra')
+    
+    def __init__(self, raw, extra=None):
+        self.raw = raw
+        self.extra = extra or {}
+
+class StdlibJSONCodec:
+    """
+    dumps() returns compact UTF-8 bytes and loads() takes str or bytes.
+    JSONFragment values are encoded as placeholder strings and then swapped
+    for their pre-serialized bytes, which works with any encoder.
+    """
+    name = 'stdlib'
+    
+    def __init__(self):
+        self._marker = f"\x00json-fragment-{uuid.uuid4().hex}:"
+    
+    def _encode(self, obj, default):
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, default=default).encode('utf-8')
+    
+    def loads(self, data):
+        return json.loads(data)
+    
+    def dumps(self, obj):
+        fragments = []
+        
+        def default(value):
+            if isinstance(value, JSONFragment):
+                fragments.append(value)
+                return f"{self._marker}{len(fragments) - 1}"
+            raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+        
+        encoded = self._encode(obj, default)
+        for index, fragment in enumerate(fragments):
+            placeholder = self._encode(f"{self._marker}{index}", None)
+            encoded = encoded.replace(placeholder, self._splice(fragment), 1)
+        return encoded
+    
+    def _splice(self, fragment):
+        if not fragment.extra:
+            return fragment.raw
+        extra = self.dumps(fragment.extra)
+        if fragment.raw == b'{}':
+            return extra
+        return fragment.raw[:-1] + b',' + extra[1:]
+
+class OrjsonJSONCodec(StdlibJSONCodec):
+    """orjson-backed codec; about an order of magnitude faster than the stdlib on large payloads"""
+    name = 'orjson'
+    
+    def _encode(self, obj, default):
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+    
+    def loads(self, data):
+        return orjson.loads(data)
+
+def create_json_codec():
+    """Build the codec selected by Config.JSON_CODEC, falling back to the stdlib"""
+    if Config.JSON_CODEC in ('auto', 'orjson') and orjson is not None:
+        return OrjsonJSONCodec()
+    if Config.JSON_CODEC == 'orjson':
+        logger.warning("JSON_CODEC=orjson but orjson is not installed; using the stdlib json module")
+    return StdlibJSONCodec()
+
+json_codec = create_json_codec()
+
+class CodecJSONProvider(DefaultJSONProvider):
+    """Routes jsonify() and request.get_json() through json_codec; responses are always compact"""
+    
+    def dumps(self, obj, **kwargs):
+        return json_codec.dumps(obj).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return json_codec.loads(s)
+
+app.json = CodecJSONProvider(app)
+
+class QuestionJSONCache:
+    """
+    Client view of staged questions, serialized once per (session, question)
+    and reused by every response that renders it. Staged questions never
+    change, so entries only ever leave by LRU eviction.
+    """
+    
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, session_id, question_id):
+        key = (session_id, question_id)
+        with self._lock:
+            raw = self._entries.get(key)
+            if raw is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return raw
+    
+    def put(self, session_id, question_id, raw):
+        with self._lock:
+            self._entries[(session_id, question_id)] = raw
+            self._entries.move_to_end((session_id, question_id))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'codec': json_codec.name,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+question_json_cache = QuestionJSONCache(Config.QUESTION_JSON_CACHE_SIZE)
+
+# ------------------------------------------------------------------
+#  METRICS: labelled counters and fixed-bucket histograms, served at /api/metrics
+# ------------------------------------------------------------------
+# Values are per worker process; a Prometheus scrape of each worker sums them.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Monotonic counter with labels"""
+    
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = defaultdict(int)  # label values -> count
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] += amount
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    """Fixed-bucket histogram with labels; observe() is a bisect and three increments"""
+    
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}  # label values -> [per-bucket counts (+Inf last), sum, count]
+    
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with-block, including when it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, list(counts), total, count) for key, (counts, total, count) in self._series.items())
+        for key, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = bound if bound == "+Inf" else _format_value(float(bound))
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+class GaugeCallback:
+    """Gauge read from a callback at scrape time, so hot paths pay nothing for it"""
+    
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+    
+    def render(self):
+        try:
+            value = self.read()
+        except Exception as e:
+            logger.warning(f"Metric {self.name} unavailable: {e}")
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge",
+                f"{self.name} {_format_value(value)}"]
+
+class MetricsRegistry:
+    """All metrics of this process, rendered in the Prometheus text exposition format"""
+    
+    def __init__(self):
+        self._metrics = []
+    
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+    
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+    
+    def gauge(self, name, help_text, read):
+        return self._register(GaugeCallback(name, help_text, read))
+    
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "alp3_http_request_seconds", "API request latency by route", ("route", "method", "status"))
+LLM_CALL_SECONDS = metrics.histogram(
+    "alp3_llm_call_seconds", "OpenAI call latency including retries", ("call_type", "mode", "outcome"))
+LLM_ATTEMPTS = metrics.counter(
+    "alp3_llm_attempts_total", "OpenAI HTTP attempts by result (ok, HTTP status or error type)", ("call_type", "result"))
+LLM_QUEUE_WAIT_SECONDS = metrics.histogram(
+    "alp3_llm_queue_wait_seconds", "Time an OpenAI call waited for an LLM scheduler slot", ("lane",))
+STAGE_SECONDS = metrics.histogram(
+    "alp3_stage_seconds", "Latency of internal pipeline stages", ("stage",))
+
+metrics.gauge("alp3_active_sessions", "Sessions in the session store", lambda: session_store.count())
+metrics.gauge("alp3_llm_in_flight", "OpenAI calls holding an LLM scheduler slot", lambda: llm_scheduler.in_flight)
+metrics.gauge("alp3_llm_circuit_open", "1 while the OpenAI circuit breaker rejects calls",
+              lambda: int(llm_breaker.get_stats()["state"] == "open"))
+
+def timed_llm_call(mode):
+    """Decorator observing an OpenAI call (sync, async or streamed) in LLM_CALL_SECONDS"""
+    def decorate(fn):
+        def observe(started, kwargs, outcome):
+            LLM_CALL_SECONDS.observe(time.perf_counter() - started, call_type=kwargs.get('call_type') or "other",
+                                     mode=mode, outcome=outcome)
+        
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                outcome = "error"
+                try:
+                    result = await fn(*args, **kwargs)
+                    outcome = "ok"
+                    return result
+                except asyncio.CancelledError:
+                    outcome = "cancelled"
+                    raise
+                finally:
+                    observe(started, kwargs, outcome)
+            return async_wrapper
+        
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def stream_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                outcome = "error"
+                try:
+                    yield from fn(*args, **kwargs)
+                    outcome = "ok"
+                except GeneratorExit:
+                    outcome = "cancelled"
+                    raise
+                finally:
+                    observe(started, kwargs, outcome)
+            return stream_wrapper
+        
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                result = fn(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                observe(started, kwargs, outcome)
+        return wrapper
+    return decorate
+
+def timed_stage(stage):
+    """Decorator observing a sync or async function's duration in STAGE_SECONDS"""
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with STAGE_SECONDS.time(stage=stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+        
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(stage=stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+class PooledHTTPClient:
+    """Shared keep-alive HTTP session with connection pool metrics"""
+    
+    def __init__(self, pool_size, connect_timeout, read_timeout):
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._connections_opened = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        
+        self.session = requests.Session()
+        # Block instead of opening overflow connections so pool_size is a hard cap
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        adapter.poolmanager.pool_classes_by_scheme = {
+            'http': self._instrumented(HTTPConnectionPool),
+            'https': self._instrumented(HTTPSConnectionPool)
+        }
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+    
+    def _instrumented(self, pool_class):
+        """Build a pool class that reports connection checkouts back to this client"""
+        client = self
+        
+        class InstrumentedPool(pool_class):
+            def _get_conn(self, timeout=None):
+                start = time.perf_counter()
+                try:
+                    return super()._get_conn(timeout=timeout)
+                finally:
+                    client._record_wait(time.perf_counter() - start)
+            
+            def _new_conn(self):
+                with client._lock:
+                    client._connections_opened += 1
+                return super()._new_conn()
+        
+        return InstrumentedPool
+    
+    def _record_wait(self, seconds):
+        with self._lock:
+            self._requests += 1
+            self._wait_total += seconds
+            self._wait_max = max(self._wait_max, seconds)
+    
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(url, **kwargs)
+    
+    def get_stats(self):
+        """Snapshot of pool usage for the health endpoint"""
+        with self._lock:
+            requests_made = self._requests
+            opened = self._connections_opened
+            wait_total = self._wait_total
+            wait_max = self._wait_max
+        reused = max(0, requests_made - opened)
+        return {
+            "pool_size": self.pool_size,
+            "requests": requests_made,
+            "connections_opened": opened,
+            "reuse_ratio": round(reused / requests_made, 3) if requests_made else 0.0,
+            "avg_wait_ms": round(wait_total / requests_made * 1000, 3) if requests_made else 0.0,
+            "max_wait_ms": round(wait_max * 1000, 3)
+        }
+
+# Shared by every OpenAI call so connections (and TLS sessions) are reused across requests
+llm_http = PooledHTTPClient(Config.OPENAI_POOL_SIZE, Config.OPENAI_CONNECT_TIMEOUT, Config.OPENAI_READ_TIMEOUT)
+
+# ------------------------------------------------------------------
+#  TOKEN ACCOUNTING + ADAPTIVE max_tokens
+# ------------------------------------------------------------------
+# Session charged for LLM calls made in the current thread or asyncio task
+llm_session_scope = contextvars.ContextVar('llm_session_scope', default=None)
+
+class TokenLedger:
+    """Process-wide token usage per call type; sizes max_tokens from recently observed output"""
+    
+    DEFAULT_MAX_TOKENS = {"study_plan": 2048, "batch": 4096, "mastery": 2048, "mastery_batch": 4096}
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._usage = {}
+        self._recent = defaultdict(lambda: deque(maxlen=Config.MAX_TOKENS_WINDOW))
+        self._pending = OrderedDict()  # usage of sessions that are not registered yet
+        self.budget_rejections = 0
+    
+    def max_tokens_for(self, call_type):
+        """Largest recent completion plus headroom, once enough calls of this type were seen"""
+        with self._lock:
+            recent = self._recent.get(call_type)
+            if not recent or len(recent) < Config.MAX_TOKENS_MIN_SAMPLES:
+                return min(Config.MAX_TOKENS_CEILING, self.DEFAULT_MAX_TOKENS.get(call_type, Config.MAX_TOKENS_CEILING))
+            observed = max(recent)
+        return min(Config.MAX_TOKENS_CEILING, max(Config.MAX_TOKENS_FLOOR, int(observed * Config.MAX_TOKENS_HEADROOM)))
+    
+    def record(self, call_type, prompt_tokens, completion_tokens, max_tokens, truncated):
+        with self._lock:
+            usage = self._usage.setdefault(call_type, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "truncated": 0})
+            usage["calls"] += 1
+            usage["prompt_tokens"] += prompt_tokens
+            usage["completion_tokens"] += completion_tokens
+            if truncated:
+                # A truncated completion hides its real size; assume it needed twice the limit
+                usage["truncated"] += 1
+                self._recent[call_type].append(min(Config.MAX_TOKENS_CEILING, max_tokens * 2))
+            elif completion_tokens:
+                self._recent[call_type].append(completion_tokens)
+    
+    def hold_pending(self, session_id, call_type, prompt_tokens, completion_tokens):
+        with self._lock:
+            self._pending[session_id] = add_token_usage(self._pending.get(session_id), call_type, prompt_tokens, completion_tokens)
+            self._pending.move_to_end(session_id)
+            while len(self._pending) > 1024:  # Sessions that never got registered
+                self._pending.popitem(last=False)
+    
+    def peek_pending(self, session_id):
+        with self._lock:
+            return self._pending.get(session_id)
+    
+    def take_pending(self, session_id):
+        with self._lock:
+            return self._pending.pop(session_id, None) or {}
+    
+    def reject(self):
+        with self._lock:
+            self.budget_rejections += 1
+    
+    def get_stats(self):
+        with self._lock:
+            by_type = {call_type: dict(usage) for call_type, usage in self._usage.items()}
+        for call_type, usage in by_type.items():
+            usage["max_tokens"] = self.max_tokens_for(call_type)
+        return {
+            "by_call_type": by_type,
+            "prompt_tokens": sum(u["prompt_tokens"] for u in by_type.values()),
+            "completion_tokens": sum(u["completion_tokens"] for u in by_type.values()),
+            "session_budget": Config.SESSION_TOKEN_BUDGET,
+            "budget_rejections": self.budget_rejections
+        }
+
+token_ledger = TokenLedger()
+
+@contextmanager
+def charging_session(session_id):
+    """Charge LLM calls made inside the block to session_id"""
+    token = llm_session_scope.set(session_id)
+    try:
+        yield
+    finally:
+        llm_session_scope.reset(token)
+
+def charged_iter(session_id, iterable):
+    """Iterate a lazy LLM-backed iterable under charging_session without leaking the scope across yields"""
+    iterator = iter(iterable)
+    while True:
+        with charging_session(session_id):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+def add_token_usage(token_usage, call_type, prompt_tokens, completion_tokens):
+    """Copy of a per-call-type usage dict with one more call added"""
+    token_usage = {kind: dict(entry) for kind, entry in (token_usage or {}).items()}
+    entry = token_usage.setdefault(call_type, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+    entry["calls"] += 1
+    entry["prompt_tokens"] += prompt_tokens
+    entry["completion_tokens"] += completion_tokens
+    return token_usage
+
+def total_tokens(token_usage):
+    return sum(entry["prompt_tokens"] + entry["completion_tokens"] for entry in (token_usage or {}).values())
+
+def check_token_budget():
+    """Refuse an LLM call once the session in scope has spent SESSION_TOKEN_BUDGET"""
+    session_id = llm_session_scope.get()
+    if not session_id or not Config.SESSION_TOKEN_BUDGET:
+        return
+    session = session_store.load(session_id, ['token_usage'])
+    token_usage = session['token_usage'] if session else token_ledger.peek_pending(session_id)
+    if total_tokens(token_usage) >= Config.SESSION_TOKEN_BUDGET:
+        token_ledger.reject()
+        raise APIError("Session token budget exhausted", 429)
+
+def record_token_usage(call_type, usage, max_tokens, truncated):
+    """Add a call's usage block to the global ledger and to the session in scope"""
+    try:
+        prompt_tokens = (usage or {}).get('prompt_tokens', 0)
+        completion_tokens = (usage or {}).get('completion_tokens', 0)
+        token_ledger.record(call_type, prompt_tokens, completion_tokens, max_tokens, truncated)
+        
+        session_id = llm_session_scope.get()
+        if not session_id:
+            return
+        
+        def charge(fields):
+            return {'token_usage': add_token_usage(fields['token_usage'], call_type, prompt_tokens, completion_tokens)}
+        
+        if session_store.transaction(session_id, ['token_usage'], charge) is None:
+            # Study plan and batch 0 are generated before the session is stored
+            token_ledger.hold_pending(session_id, call_type, prompt_tokens, completion_tokens)
+    except Exception as e:
+        logger.error(f"Token accounting error: {e}")
+# ------------------------------------------------------------------
+
+class LLMLatencyTracker:
+    """Recent end-to-end latency per call type, including scheduler queueing and retries"""
+    
+    DEFAULT_SECONDS = 20.0
+    MIN_SAMPLES = 5
+    
+    def __init__(self, window=100):
+        self._recent = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+    
+    def record(self, call_type, seconds):
+        with self._lock:
+            self._recent[call_type].append(seconds)
+    
+    def estimate(self, call_type):
+        """90th percentile of recent calls, or a conservative default until enough were seen"""
+        with self._lock:
+            recent = sorted(self._recent.get(call_type, ()))
+        if len(recent) < self.MIN_SAMPLES:
+            return self.DEFAULT_SECONDS
+        return recent[int(0.9 * (len(recent) - 1))]
+    
+    def get_stats(self):
+        with self._lock:
+            call_types = list(self._recent)
+        return {call_type: {"p90_seconds": round(self.estimate(call_type), 3),
+                            "samples": len(self._recent[call_type])} for call_type in call_types}
+
+llm_latency = LLMLatencyTracker()
+
+# ------------------------------------------------------------------
+#  RETRY BACKOFF + CIRCUIT BREAKER
+# ------------------------------------------------------------------
+# Throttling, timeouts and server errors are worth retrying; other 4xx are not
+RETRYABLE_STATUS = frozenset({408, 409, 429, 500, 502, 503, 504})
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date), or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff; a Retry-After from the provider takes precedence"""
+    if retry_after is not None:
+        return min(Config.LLM_RETRY_MAX_SECONDS, retry_after) + random.uniform(0, Config.LLM_RETRY_BASE_SECONDS)
+    return random.uniform(0, min(Config.LLM_RETRY_MAX_SECONDS, Config.LLM_RETRY_BASE_SECONDS * 2 ** attempt))
+
+class CircuitBreaker:
+    """
+    Shared across every LLM call in the process. Opens after consecutive
+    provider failures so callers fail fast to fallback content, then lets a
+    single probe call through once the cooldown has passed.
+    """
+    
+    def __init__(self, failure_threshold, cooldown_seconds):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.times_opened = 0
+        self.rejected_calls = 0
+        self.last_failure = None
+        self.stale_probes = 0
+        self._probe_in_flight = False
+        self._probe_deadline = 0.0
+        self._lock = threading.Lock()
+    
+    def before_call(self):
+        """
+        Raise APIError(503) instead of calling a provider that is known to be
+        unhealthy. Returns True when this call is the half-open probe; the
+        caller must then call release_probe() once the attempt is over.
+        """
+        with self._lock:
+            if self.state == "closed":
+                return False
+            now = time.time()
+            if self.state == "half_open" and self._probe_in_flight and now >= self._probe_deadline:
+                # The probe never reported back: count it as failed and reopen
+                logger.warning("LLM circuit breaker probe timed out; reopening")
+                self.stale_probes += 1
+                self.state = "open"
+                self.open_until = self._probe_deadline
+                self._probe_in_flight = False
+            if self.state == "open":
+                if now < self.open_until:
+                    self.rejected_calls += 1
+                    raise APIError("LLM provider unavailable (circuit open)", 503)
+                self.state = "half_open"
+                self._probe_in_flight = False
+            if self._probe_in_flight:
+                self.rejected_calls += 1
+                raise APIError("LLM provider unavailable (circuit half-open)", 503)
+            self._probe_in_flight = True
+            self._probe_deadline = now + self.cooldown_seconds
+            return True
+    
+    def release_probe(self):
+        """Free the probe slot of an attempt that ended without a verdict (cancelled or crashed)"""
+        with self._lock:
+            if self.state == "half_open":
+                self._probe_in_flight = False
+    
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info("LLM circuit breaker closed")
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+    
+    def record_failure(self, reason, retry_after=None):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.last_failure = reason
+            if self.state == "open":
+                # A call that was in flight when the breaker tripped; only honour a longer Retry-After
+                if retry_after:
+                    self.open_until = max(self.open_until, time.time() + retry_after)
+                return
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                self.state = "open"
+                self.open_until = time.time() + max(self.cooldown_seconds, retry_after or 0)
+                self.times_opened += 1
+                self._probe_in_flight = False
+                logger.warning(f"LLM circuit breaker opened after {self.consecutive_failures} failures ({reason})")
+    
+    def get_stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "open_for_seconds": round(max(0.0, self.open_until - time.time()), 1) if self.state == "open" else 0,
+                "times_opened": self.times_opened,
+                "rejected_calls": self.rejected_calls,
+                "stale_probes": self.stale_probes,
+                "last_failure": self.last_failure
+            }
+
+llm_breaker = CircuitBreaker(Config.BREAKER_FAILURE_THRESHOLD, Config.BREAKER_COOLDOWN_SECONDS)
+# ------------------------------------------------------------------
+
+# ------------------------------------------------------------------
+#  LLM SCHEDULER: priority lanes, global concurrency and TPM limits
+# ------------------------------------------------------------------
+# foreground: a user is waiting on it; near_term: the next batch a student will reach;
+# speculative: prefetch, later batches and mastery questions for later slots
+LLM_LANES = ("foreground", "near_term", "speculative")
+
+# (lane, deadline) for LLM calls made in the current thread or asyncio task
+llm_priority = contextvars.ContextVar('llm_priority', default=("foreground", None))
+# SingleFlight call the current request is serving, so waiting followers can raise its priority
+llm_flight = contextvars.ContextVar('llm_flight', default=None)
+
+def current_priority_key():
+    """Sort key for the request in scope: lane first, then earliest deadline"""
+    lane, deadline = llm_priority.get()
+    return (LLM_LANES.index(lane), deadline if deadline is not None else math.inf)
+
+def estimate_request_tokens(data):
+    """Prompt tokens (about 4 characters each) plus the completion allowance"""
+    return sum(len(message['content']) for message in data['messages']) // 4 + data['max_tokens']
+
+class _SchedulerWaiter:
+    __slots__ = ("key", "seq", "tokens", "wake", "granted", "cancelled", "window_entry", "enqueued_at")
+    
+    def __init__(self, key, seq, tokens, wake):
+        self.key = key
+        self.seq = seq
+        self.tokens = tokens
+        self.wake = wake
+        self.granted = False
+        self.cancelled = False
+        self.window_entry = None
+        self.enqueued_at = time.time()
+
+class LLMScheduler:
+    """
+    Admits LLM calls from threads and the event loop in priority order:
+    lane, then earliest deadline, then arrival. Background lanes cannot take
+    the slots reserved for foreground work, and all lanes share one
+    tokens-per-minute window.
+    """
+    
+    def __init__(self, max_concurrency, reserved_foreground, tokens_per_minute):
+        self.max_concurrency = max_concurrency
+        self.reserved_foreground = min(reserved_foreground, max_concurrency - 1)
+        self.tokens_per_minute = tokens_per_minute
+        self.in_flight = 0
+        self._queue = []       # heap of (key, seq, waiter); entries whose key is stale are skipped
+        self._window = deque() # [granted_at, tokens] for grants in the last minute
+        self._seq = itertools.count()
+        self._timer = None
+        self._lock = threading.Lock()
+        self.granted = defaultdict(int)
+        self.wait_ms_total = defaultdict(float)
+        self.max_wait_ms = defaultdict(float)
+        self.promotions = 0
+    
+    def _enqueue(self, tokens, wake):
+        key = current_priority_key()
+        flight = llm_flight.get()
+        if flight is not None:
+            key = min(key, flight.priority)
+        waiter = _SchedulerWaiter(key, next(self._seq), tokens, wake)
+        with self._lock:
+            if flight is not None:
+                flight.waiter = waiter
+            heapq.heappush(self._queue, (key, waiter.seq, waiter))
+            self._dispatch_locked()
+        return waiter
+    
+    def acquire(self, tokens):
+        """Block the calling thread until the request may start; returns a ticket for release()"""
+        started = time.perf_counter()
+        event = threading.Event()
+        waiter = self._enqueue(tokens, event.set)
+        event.wait()
+        LLM_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - started, lane=LLM_LANES[waiter.key[0]])
+        return waiter
+    
+    async def acquire_async(self, tokens):
+        """Event-loop variant of acquire() that never blocks the loop"""
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+        
+        waiter = self._enqueue(tokens, wake)
+        try:
+            await granted
+        except asyncio.CancelledError:
+            with self._lock:
+                waiter.cancelled = True
+                if waiter.granted:
+                    self._release_locked(waiter, None)
+            raise
+        LLM_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - started, lane=LLM_LANES[waiter.key[0]])
+        return waiter
+    
+    def release(self, waiter, usage=None):
+        """Free the slot; the real usage replaces the estimate in the TPM window"""
+        with self._lock:
+            self._release_locked(waiter, usage)
+    
+    def _release_locked(self, waiter, usage):
+        self.in_flight -= 1
+        if usage and waiter.window_entry is not None:
+            waiter.window_entry[1] = usage.get('total_tokens') or (
+                usage.get('prompt_tokens', 0) + usage.get('completion_tokens', 0))
+        self._dispatch_locked()
+    
+    def promote(self, flight, key):
+        """Raise a queued single-flight leader to the priority of a more urgent follower"""
+        with self._lock:
+            if key >= flight.priority:
+                return
+            flight.priority = key
+            waiter = flight.waiter
+            if waiter is None or waiter.granted or waiter.cancelled or key >= waiter.key:
+                return
+            waiter.key = key
+            heapq.heappush(self._queue, (key, waiter.seq, waiter))
+            self.promotions += 1
+            self._dispatch_locked()
+    
+    def _dispatch_locked(self):
+        now = time.time()
+        while self._window and self._window[0][0] <= now - 60:
+            self._window.popleft()
+        tokens_used = sum(tokens for _, tokens in self._window)
+        
+        while self._queue:
+            key, _, waiter = self._queue[0]
+            if waiter.granted or waiter.cancelled or key != waiter.key:
+                heapq.heappop(self._queue)
+                continue
+            limit = self.max_concurrency if key[0] == 0 else self.max_concurrency - self.reserved_foreground
+            if self.in_flight >= limit:
+                break  # Everything behind the head is no more urgent
+            if self.tokens_per_minute and self._window and tokens_used + waiter.tokens > self.tokens_per_minute:
+                self._dispatch_later(self._window[0][0] + 60 - now)
+                break
+            
+            heapq.heappop(self._queue)
+            waiter.granted = True
+            waiter.window_entry = [now, waiter.tokens]
+            self._window.append(waiter.window_entry)
+            tokens_used += waiter.tokens
+            self.in_flight += 1
+            
+            lane = LLM_LANES[key[0]]
+            wait_ms = (now - waiter.enqueued_at) * 1000
+            self.granted[lane] += 1
+            self.wait_ms_total[lane] += wait_ms
+            self.max_wait_ms[lane] = max(self.max_wait_ms[lane], wait_ms)
+            waiter.wake()
+    
+    def _dispatch_later(self, delay):
+        """Re-run dispatch once the TPM window has room again"""
+        if self._timer is not None and self._timer.is_alive():
+            return
+        self._timer = threading.Timer(max(0.01, delay), self._dispatch)
+        self._timer.daemon = True
+        self._timer.start()
+    
+    def _dispatch(self):
+        with self._lock:
+            self._dispatch_locked()
+    
+    def get_stats(self):
+        with self._lock:
+            queued = defaultdict(int)
+            for key, _, waiter in self._queue:
+                if not (waiter.granted or waiter.cancelled or key != waiter.key):
+                    queued[LLM_LANES[key[0]]] += 1
+            return {
+                "in_flight": self.in_flight,
+                "max_concurrency": self.max_concurrency,
+                "reserved_foreground": self.reserved_foreground,
+                "tokens_per_minute_limit": self.tokens_per_minute,
+                "tokens_last_minute": sum(tokens for _, tokens in self._window),
+                "promotions": self.promotions,
+                "lanes": {
+                    lane: {
+                        "queued": queued[lane],
+                        "granted": self.granted[lane],
+                        "avg_wait_ms": round(self.wait_ms_total[lane] / self.granted[lane], 2) if self.granted[lane] else 0.0,
+                        "max_wait_ms": round(self.max_wait_ms[lane], 2)
+                    }
+                    for lane in LLM_LANES
+                }
+            }
+
+llm_scheduler = LLMScheduler(Config.LLM_MAX_CONCURRENCY, Config.LLM_FOREGROUND_RESERVED_SLOTS, Config.LLM_TOKENS_PER_MINUTE)
+# ------------------------------------------------------------------
+
+def _build_openai_request(prompt, system_message=None, temperature=0.3, response_format=None, call_type=None):
+    """Build headers and JSON body for a chat completions call"""
+    headers = {
+        'Authorization': f'Bearer {Config.OPENAI_API_KEY}',
+        'Content-Type': 'application/json'
+    }
+    
+    messages = []
+    if system_message:
+        messages.append({'role': 'system', 'content': system_message})
+    messages.append({'role': 'user', 'content': prompt})
+    
+    data = {
+        'model': Config.OPENAI_MODEL,  # Configurable model from environment
+        'messages': messages,
+        'temperature': temperature,
+        'max_tokens': token_ledger.max_tokens_for(call_type)
+    }
+    
+    # Add response format if specified
+    if response_format:
+        data['response_format'] = response_format
+    
+    return headers, data
+
+@timed_llm_call("sync")
+def call_openai_api(prompt, system_message=None, temperature=0.3, max_retries=3, response_format=None, call_type=None):
+    """Call OpenAI API with improved parameters and error handling"""
+    check_token_budget()
+    headers, data = _build_openai_request(prompt, system_message, temperature, response_format, call_type)
+    started = time.perf_counter()
+    
+    for attempt in range(max_retries):
+        probe = llm_breaker.before_call()
+        retry_after = None
+        usage = None
+        ticket = None
+        try:
+            ticket = llm_scheduler.acquire(estimate_request_tokens(data))
+            logger.info(f"Making OpenAI API call (attempt {attempt + 1}) with model {Config.OPENAI_MODEL}")
+            response = llm_http.post(
+                Config.OPENAI_API_URL, 
+                headers=headers, 
+                data=json_codec.dumps(data)
+            )
+            response.raise_for_status()
+            
+            result = json_codec.loads(response.content)
+            content = result['choices'][0]['message']['content']
+            usage = result.get('usage')
+            llm_breaker.record_success()
+            record_token_usage(call_type, usage, data['max_tokens'],
+                               result['choices'][0].get('finish_reason') == 'length')
+            llm_latency.record(call_type, time.perf_counter() - started)
+            LLM_ATTEMPTS.inc(call_type=call_type or "other", result="ok")
+            
+            logger.info("OpenAI API call successful")
+            return content
+            
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code
+            LLM_ATTEMPTS.inc(call_type=call_type or "other", result=str(status))
+            logger.error(f"OpenAI API HTTP {status} (attempt {attempt + 1}): {e}")
+            if status not in RETRYABLE_STATUS:
+                llm_breaker.record_success()  # The provider is up; the request itself was rejected
+                raise APIError(f"OpenAI API rejected the request: {str(e)}", status)
+            retry_after = parse_retry_after(e.response.headers.get('Retry-After'))
+            llm_breaker.record_failure(f"HTTP {status}", retry_after)
+            error = e
+        except requests.exceptions.RequestException as e:
+            LLM_ATTEMPTS.inc(call_type=call_type or "other", result=type(e).__name__)
+            logger.error(f"OpenAI API request error (attempt {attempt + 1}): {e}")
+            llm_breaker.record_failure(type(e).__name__)
+            error = e
+        except json.JSONDecodeError as e:
+            LLM_ATTEMPTS.inc(call_type=call_type or "other", result="bad_json")
+            logger.error(f"OpenAI API returned a non-JSON body: {e}")
+            llm_breaker.record_failure("bad_json")
+            raise APIError("Invalid JSON response from OpenAI API", 502)
+        except (KeyError, IndexError, TypeError) as e:
+            LLM_ATTEMPTS.inc(call_type=call_type or "other", result="bad_response")
+            logger.error(f"OpenAI API response format error: {e}")
+            llm_breaker.record_success()
+            raise APIError("Invalid response format from OpenAI API")
+        except Exception as e:
+            LLM_ATTEMPTS.inc(call_type=call_type or "other", result=type(e).__name__)
+            logger.error(f"Unexpected error in OpenAI API call: {e}")
+            llm_breaker.record_failure(type(e).__name__)
+            error = e
+        finally:
+            if ticket is not None:
+                llm_scheduler.release(ticket, usage)
+            if probe:
+                llm_breaker.release_probe()
+        
+        if attempt == max_retries - 1:
+            raise APIError(f"OpenAI API request failed after {max_retries} attempts: {str(error)}")
+        delay = backoff_delay(attempt, retry_after)
+        logger.warning(f"Retrying OpenAI API call in {delay:.2f}s")
+        time.sleep(delay)
+
+class LLMEventLoop:
+    """Background asyncio loop hosting async OpenAI I/O for the whole process"""
+    
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._loop = None
+        self._thread = None
+        self._http = None
+        self._in_flight_limit = None
+        self._start_lock = threading.Lock()
+    
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._loop is not None:
+                return self._loop
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._loop.run_forever, name="llm-event-loop", daemon=True)
+            self._thread.start()
+            return self._loop
+    
+    def submit(self, coro):
+        """Schedule a coroutine on the loop; returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_started())
+    
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the loop and block the calling thread for its result"""
+        return self.submit(coro).result(timeout)
+    
+    def get_http_session(self):
+        """Shared aiohttp session; must be called from the loop thread"""
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+                timeout=aiohttp.ClientTimeout(
+                    connect=Config.OPENAI_CONNECT_TIMEOUT,
+                    sock_read=Config.OPENAI_READ_TIMEOUT
+                )
+            )
+        return self._http
+    
+    def get_in_flight_limit(self):
+        """Semaphore bounding concurrent calls; must be called from the loop thread"""
+        if self._in_flight_limit is None:
+            self._in_flight_limit = asyncio.Semaphore(self.max_in_flight)
+        return self._in_flight_limit
+    
+    def get_stats(self):
+        return {
+            "running": self._loop is not None,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight
+        }
+
+llm_loop = LLMEventLoop(Config.ASYNC_MAX_IN_FLIGHT)
+
+class SessionWork:
+    """Tracks each session's background generation so ending the session cancels it"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = {}  # session_id -> cancellation token: the set of its outstanding futures
+        self.submitted = 0
+        self.cancelled_sessions = 0
+        self.cancelled_tasks = 0
+    
+    def submit(self, session_id, coro):
+        """Schedule a session's coroutine on llm_loop; returns its future"""
+        with self._lock:
+            token = self._tokens.setdefault(session_id, set())
+            future = llm_loop.submit(coro)
+            token.add(future)
+            self.submitted += 1
+        future.add_done_callback(lambda f: self._discard(session_id, token, f))
+        return future
+    
+    def _discard(self, session_id, token, future):
+        with self._lock:
+            token.discard(future)
+            if not token and self._tokens.get(session_id) is token:
+                del self._tokens[session_id]
+    
+    def cancel(self, session_id):
+        """
+        Cancel the session's queued and in-flight work. Cancelling the task
+        aborts its HTTP request and frees its scheduler slot. Returns how many
+        tasks were still outstanding.
+        """
+        with self._lock:
+            token = self._tokens.pop(session_id, None)
+            if token is None:
+                return 0
+            futures = list(token)
+        cancelled = sum(1 for future in futures if future.cancel())
+        with self._lock:
+            self.cancelled_sessions += 1
+            self.cancelled_tasks += cancelled
+        if cancelled:
+            logger.info(f"Cancelled {cancelled} background tasks for session {session_id}")
+        return cancelled
+    
+    def get_stats(self):
+        with self._lock:
+            return {
+                "sessions_with_work": len(self._tokens),
+                "outstanding_tasks": sum(len(token) for token in self._tokens.values()),
+                "submitted": self.submitted,
+                "cancelled_sessions": self.cancelled_sessions,
+                "cancelled_tasks": self.cancelled_tasks
+            }
+
+session_work = SessionWork()
+
+@timed_llm_call("async")
+async def async_call_openai_api(prompt, system_message=None, temperature=0.3, max_retries=3, response_format=None, call_type=None):
+    """Event-loop variant of call_openai_api; must run on llm_loop"""
+    await asyncio.to_thread(check_token_budget)
+    headers, data = _build_openai_request(prompt, system_message, temperature, response_format, call_type)
+    session = llm_loop.get_http_session()
+    started = time.perf_counter()
+    
+    async with llm_loop.get_in_flight_limit():
+        llm_loop.in_flight += 1
+        try:
+            for attempt in range(max_retries):
+                probe = llm_breaker.before_call()
+                retry_after = None
+                usage = None
+                ticket = None
+                try:
+                    ticket = await llm_scheduler.acquire_async(estimate_request_tokens(data))
+                    logger.info(f"Making async OpenAI API call (attempt {attempt + 1}) with model {Config.OPENAI_MODEL}")
+                    async with session.post(Config.OPENAI_API_URL, headers=headers, data=json_codec.dumps(data)) as response:
+                        response.raise_for_status()
+                        result = json_codec.loads(await response.read())
+                    content = result['choices'][0]['message']['content']
+                    usage = result.get('usage')
+                    llm_breaker.record_success()
+                    await asyncio.to_thread(record_token_usage, call_type, usage, data['max_tokens'],
+                                            result['choices'][0].get('finish_reason') == 'length')
+                    llm_latency.record(call_type, time.perf_counter() - started)
+                    LLM_ATTEMPTS.inc(call_type=call_type or "other", result="ok")
+                    
+                    logger.info("Async OpenAI API call successful")
+                    return content
+                    
+                except aiohttp.ClientResponseError as e:
+                    LLM_ATTEMPTS.inc(call_type=call_type or "other", result=str(e.status))
+                    logger.error(f"Async OpenAI API HTTP {e.status} (attempt {attempt + 1}): {e.message}")
+                    if e.status not in RETRYABLE_STATUS:
+                        llm_breaker.record_success()  # The provider is up; the request itself was rejected
+                        raise APIError(f"OpenAI API rejected the request: {e.status} {e.message}", e.status)
+                    retry_after = parse_retry_after(e.headers.get('Retry-After') if e.headers else None)
+                    llm_breaker.record_failure(f"HTTP {e.status}", retry_after)
+                    error = e
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    LLM_ATTEMPTS.inc(call_type=call_type or "other", result=type(e).__name__)
+                    logger.error(f"Async OpenAI API request error (attempt {attempt + 1}): {e}")
+                    llm_breaker.record_failure(type(e).__name__)
+                    error = e
+                except json.JSONDecodeError as e:
+                    LLM_ATTEMPTS.inc(call_type=call_type or "other", result="bad_json")
+                    logger.error(f"Async OpenAI API returned a non-JSON body: {e}")
+                    llm_breaker.record_failure("bad_json")
+                    raise APIError("Invalid JSON response from OpenAI API", 502)
+                except (KeyError, IndexError, TypeError) as e:
+                    LLM_ATTEMPTS.inc(call_type=call_type or "other", result="bad_response")
+                    logger.error(f"OpenAI API response format error: {e}")
+                    llm_breaker.record_success()
+                    raise APIError("Invalid response format from OpenAI API")
+                except Exception as e:
+                    LLM_ATTEMPTS.inc(call_type=call_type or "other", result=type(e).__name__)
+                    logger.error(f"Unexpected error in async OpenAI API call: {e}")
+                    llm_breaker.record_failure(type(e).__name__)
+                    raise
+                finally:
+                    if ticket is not None:
+                        llm_scheduler.release(ticket, usage)
+                    if probe:
+                        llm_breaker.release_probe()
+                
+                if attempt == max_retries - 1:
+                    raise APIError(f"OpenAI API request failed after {max_retries} attempts: {str(error)}")
+                delay = backoff_delay(attempt, retry_after)
+                logger.warning(f"Retrying async OpenAI API call in {delay:.2f}s")
+                await asyncio.sleep(delay)
+        finally:
+            llm_loop.in_flight -= 1
+
+@timed_llm_call("stream")
+def stream_openai_api(prompt, system_message=None, temperature=0.3, response_format=None, call_type=None):
+    """Call OpenAI API with stream=true, yielding content deltas as they arrive"""
+    check_token_budget()
+    headers, data = _build_openai_request(prompt, system_message, temperature, response_format, call_type)
+    data['stream'] = True
+    data['stream_options'] = {'include_usage': True}  # Final chunk carries the usage block
+    
+    # Streams are not retried: the caller falls back as soon as this fails
+    probe = llm_breaker.before_call()
+    usage = None
+    ticket = None
+    try:
+        ticket = llm_scheduler.acquire(estimate_request_tokens(data))  # Held until the stream ends or is abandoned
+        try:
+            logger.info(f"Making streaming OpenAI API call with model {Config.OPENAI_MODEL}")
+            response = llm_http.post(Config.OPENAI_API_URL, headers=headers, data=json_codec.dumps(data), stream=True)
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code
+            LLM_ATTEMPTS.inc(call_type=call_type or "other", result=str(status))
+            logger.error(f"OpenAI streaming request HTTP {status}: {e}")
+            if status in RETRYABLE_STATUS:
+                llm_breaker.record_failure(f"HTTP {status}", parse_retry_after(e.response.headers.get('Retry-After')))
+            else:
+                llm_breaker.record_success()
+            raise APIError(f"OpenAI API streaming request failed: {str(e)}", status)
+        except requests.exceptions.RequestException as e:
+            LLM_ATTEMPTS.inc(call_type=call_type or "other", result=type(e).__name__)
+            logger.error(f"OpenAI streaming request error: {e}")
+            llm_breaker.record_failure(type(e).__name__)
+            raise APIError(f"OpenAI API streaming request failed: {str(e)}")
+        llm_breaker.record_success()
+        LLM_ATTEMPTS.inc(call_type=call_type or "other", result="ok")
+        
+        truncated = False
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                payload = line[len('data:'):].strip()
+                if payload == '[DONE]':
+                    break
+                try:
+                    chunk = json_codec.loads(payload)
+                    usage = chunk.get('usage') or usage
+                    if not chunk['choices']:
+                        continue  # Usage-only chunk
+                    choice = chunk['choices'][0]
+                    delta = choice.get('delta', {}).get('content')
+                    truncated = truncated or choice.get('finish_reason') == 'length'
+                except (json.JSONDecodeError, KeyError, IndexError, AttributeError) as e:
+                    logger.error(f"OpenAI stream chunk format error: {e}")
+                    raise APIError("Invalid streaming response format from OpenAI API")
+                if delta:
+                    yield delta
+        record_token_usage(call_type, usage, data['max_tokens'], truncated)
+    finally:
+        if ticket is not None:
+            llm_scheduler.release(ticket, usage)
+        if probe:
+            llm_breaker.release_probe()
+
+class StreamingQuestionParser:
+    """Incrementally extracts complete objects from the "questions" array of a streamed JSON response"""
+    
+    ARRAY_START = re.compile(r'"questions"\s*:\s*\[')
+    
+    def __init__(self):
+        self._chunks = []
+        # Unconsumed tail: the last few characters before the array starts, then
+        # only the text of the object currently being read, so each character is
+        # copied a bounded number of times however long the response grows
+        self._buffer = ""
+        self._in_array = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._object_start = None
+    
+    @property
+    def text(self):
+        """The whole response received so far"""
+        return "".join(self._chunks)
+    
+    def feed(self, chunk):
+        """Add a chunk of response text; return any question objects completed by it"""
+        self._chunks.append(chunk)
+        completed = []
+        
+        if not self._in_array:
+            self._buffer += chunk
+            match = self.ARRAY_START.search(self._buffer)
+            if not match:
+                self._buffer = self._buffer[-32:]
+                return completed
+            self._in_array = True
+            self._buffer = self._buffer[match.end():]
+            start = 0
+        else:
+            start = len(self._buffer)
+            self._buffer += chunk
+        
+        text = self._buffer
+        for i in range(start, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == '{':
+                if self._depth == 0:
+                    self._object_start = i
+                self._depth += 1
+            elif ch == '}':
+                self._depth -= 1
+                if self._depth == 0 and self._object_start is not None:
+                    try:
+                        completed.append(json_codec.loads(text[self._object_start:i + 1]))
+                    except json.JSONDecodeError as e:
+                        logger.warning(f"Skipping unparseable streamed question: {e}")
+                    self._object_start = None
+        
+        if self._object_start is None:
+            self._buffer = ""
+        else:
+            self._buffer = text[self._object_start:]
+            self._object_start = 0
+        return completed
+
+class MemoryCacheBackend:
+    """In-process LRU cache bounded by total payload size in bytes"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, payload)
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, payload = entry
+            if expires_at < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return payload
+    
+    def set(self, key, payload, expires_at):
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, payload)
+            self.size_bytes += len(payload)
+            while self.size_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+    
+    def _remove(self, key):
+        _, payload = self._entries.pop(key)
+        self.size_bytes -= len(payload)
+    
+    def get_stats(self):
+        with self._lock:
+            return {"backend": "memory", "entries": len(self._entries), "size_bytes": self.size_bytes,
+                    "max_bytes": self.max_bytes, "evictions": self.evictions}
+
+class SQLiteCacheBackend:
+    """On-disk LRU cache in a SQLite file, shared by every process using the same path"""
+    
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS generation_cache ("
+            "key TEXT PRIMARY KEY, payload BLOB NOT NULL, size INTEGER NOT NULL, "
+            "expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_generation_cache_access ON generation_cache (last_access)")
+    
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload, expires_at FROM generation_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._conn.execute("DELETE FROM generation_cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE generation_cache SET last_access = ? WHERE key = ?", (now, key))
+            return bytes(row[0])
+    
+    def set(self, key, payload, expires_at):
+        if len(payload) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO generation_cache (key, payload, size, expires_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload), expires_at, now)
+            )
+            self._conn.execute("DELETE FROM generation_cache WHERE expires_at < ?", (now,))
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM generation_cache").fetchone()[0]
+            while total > self.max_bytes:
+                oldest = self._conn.execute(
+                    "SELECT key, size FROM generation_cache ORDER BY last_access LIMIT 1"
+                ).fetchone()
+                if oldest is None:
+                    break
+                self._conn.execute("DELETE FROM generation_cache WHERE key = ?", (oldest[0],))
+                total -= oldest[1]
+                self.evictions += 1
+    
+    def get_stats(self):
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM generation_cache"
+            ).fetchone()
+        return {"backend": "sqlite", "path": self.path, "entries": entries, "size_bytes": size,
+                "max_bytes": self.max_bytes, "evictions": self.evictions}
+
+class GenerationCache:
+    """Content-addressed cache for LLM output (study plans and raw question batches)"""
+    
+    def __init__(self, backend, ttl_seconds):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(kind, *parts):
+        """Hash the request identity together with the model and prompt version"""
+        identity = json.dumps([kind, Config.OPENAI_MODEL, Config.PROMPT_VERSION, *parts], sort_keys=True)
+        return f"{kind}:{hashlib.sha256(identity.encode('utf-8')).hexdigest()}"
+    
+    def get(self, key):
+        """Return a fresh copy of the cached value, or None on a miss"""
+        payload = self.backend.get(key) if self.backend else None
+        with self._lock:
+            if payload is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if payload is None else json_codec.loads(payload)
+    
+    def set(self, key, value):
+        if self.backend:
+            self.backend.set(key, json_codec.dumps(value), time.time() + self.ttl_seconds)
+    
+    def get_stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        stats = {"hits": hits, "misses": misses,
+                 "hit_ratio": round(hits / lookups, 3) if lookups else 0.0}
+        if self.backend:
+            stats.update(self.backend.get_stats())
+        else:
+            stats["backend"] = "none"
+        return stats
+
+def create_cache_backend():
+    """Build the cache backend selected by Config.CACHE_BACKEND"""
+    if Config.CACHE_BACKEND == 'sqlite':
+        return SQLiteCacheBackend(Config.CACHE_PATH, Config.CACHE_MAX_BYTES)
+    if Config.CACHE_BACKEND == 'memory':
+        return MemoryCacheBackend(Config.CACHE_MAX_BYTES)
+    return None
+
+generation_cache = GenerationCache(create_cache_backend(), Config.CACHE_TTL_SECONDS)
+
+class _Flight:
+    """One in-flight call shared by every concurrent caller of its key"""
+    __slots__ = ("future", "priority", "waiter")
+    
+    def __init__(self, priority):
+        self.future = Future()
+        self.priority = priority  # Most urgent scheduler key among its callers
+        self.waiter = None        # Scheduler entry of the leader's current attempt
+
+class FlightCancelled(Exception):
+    """The leader of a single-flight call was cancelled; its followers retry the call themselves"""
+
+class SingleFlight:
+    """Coalesces concurrent identical generation calls: the first caller makes the API call, the rest wait for it"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> _Flight
+        self.leader_calls = 0
+        self.saved_calls = defaultdict(int)  # per key kind
+    
+    def _join(self, key):
+        priority = current_priority_key()
+        with self._lock:
+            flight = self._calls.get(key)
+            if flight is None:
+                flight = self._calls[key] = _Flight(priority)
+                self.leader_calls += 1
+                return flight, True
+            self.saved_calls[key.split(":", 1)[0]] += 1
+        # A user waiting on speculative work must not wait behind other speculative work
+        llm_scheduler.promote(flight, priority)
+        return flight, False
+    
+    def _settle(self, key, flight, result=None, error=None):
+        with self._lock:
+            self._calls.pop(key, None)
+        if isinstance(error, asyncio.CancelledError):
+            # The leader's session ended; that must not fail followers from other sessions
+            error = FlightCancelled(key)
+        if error is not None:
+            flight.future.set_exception(error)
+        else:
+            flight.future.set_result(result)
+    
+    def do(self, key, fn):
+        """Run fn() once per key among concurrent callers; every caller gets its own copy of the result"""
+        while True:
+            flight, leader = self._join(key)
+            if leader:
+                break
+            try:
+                return copy.deepcopy(flight.future.result())
+            except FlightCancelled:
+                continue
+        token = llm_flight.set(flight)
+        try:
+            result = fn()
+        except BaseException as e:
+            self._settle(key, flight, error=e)
+            raise
+        finally:
+            llm_flight.reset(token)
+        self._settle(key, flight, result)
+        return copy.deepcopy(result)
+    
+    async def do_async(self, key, coro_fn):
+        """Event-loop variant of do(); sync and async callers of the same key share one call"""
+        while True:
+            flight, leader = self._join(key)
+            if leader:
+                break
+            try:
+                # Shielded: a cancelled follower must not cancel the call it shares with others
+                return copy.deepcopy(await asyncio.shield(asyncio.wrap_future(flight.future)))
+            except FlightCancelled:
+                continue
+        token = llm_flight.set(flight)
+        try:
+            result = await coro_fn()
+        except BaseException as e:
+            self._settle(key, flight, error=e)
+            raise
+        finally:
+            llm_flight.reset(token)
+        self._settle(key, flight, result)
+        return copy.deepcopy(result)
+    
+    def get_stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls), "leader_calls": self.leader_calls,
+                    "saved_calls": sum(self.saved_calls.values()), "saved_by_kind": dict(self.saved_calls)}
+
+single_flight = SingleFlight()
+
+def content_cache_identity(topic_or_content, content_type):
+    """Normalized topic string, or a digest of uploaded document text"""
+    if content_type == "topic":
+        return ["topic", " ".join(topic_or_content.lower().split())]
+    return ["file", hashlib.sha256(topic_or_content.encode('utf-8')).hexdigest()]
+
+def study_plan_digest(study_plan):
+    """Stable digest of a study plan, used to address the batches generated from it"""
+    return hashlib.sha256(json.dumps(study_plan, sort_keys=True).encode('utf-8')).hexdigest()
+
+# ------------------------------------------------------------------
+#  SESSION STORE: pluggable persistence for session state
+# ------------------------------------------------------------------
+# Sessions are flat records of JSON-serializable fields. Each field is stored
+# separately so hot paths can load and save only the fields they touch.
+SESSION_FIELDS = [
+    'id', 'type', 'content', 'study_plan', 'main_questions', 'current_index',
+    'current_concept_index', 'score', 'correct_answers', 'incorrect_answers',
+    'completed', 'learned_concepts', 'created_at', 'last_activity', 'next_question_id',
+    'token_usage', 'next_batch_index', 'batch_claimed_at', 'answer_pace', 'mastery_pending_at'
+]
+# Question bodies live in their own fields ("question:<id>") so one can be loaded in O(1);
+# main_questions holds only the ordered ids
+
+def question_field(question_id):
+    return f"question:{question_id}"
+
+def _encode_field(value):
+    return json_codec.dumps(value).decode('utf-8')
+
+class MemorySessionStore:
+    """
+    Process-local session store; values are kept as live Python objects.
+    Records are copy-on-write: writers serialize on a lock and swap in a new
+    dict, so reads take no lock and always see one consistent version.
+    """
+    
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.RLock()
+    
+    def create(self, session_id, fields):
+        with self._lock:
+            self._sessions[session_id] = dict(fields)
+    
+    def load(self, session_id, fields=None):
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        if fields is None:
+            return dict(session)
+        return {field: session.get(field) for field in fields}
+    
+    def save(self, session_id, fields):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return False
+            self._sessions[session_id] = {**session, **fields}
+            return True
+    
+    def transaction(self, session_id, fields, fn):
+        """Atomically read `fields`, apply fn, and save the dict of changes it returns"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            changes = fn({field: session.get(field) for field in fields})
+            if changes:
+                self._sessions[session_id] = {**session, **changes}
+            return changes
+    
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+    
+    def count(self):
+        return len(self._sessions)
+    
+    def session_ids(self):
+        with self._lock:
+            return list(self._sessions)
+
+class SQLiteSessionStore:
+    """File-backed session store; safe across worker processes sharing the file"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS session_fields ("
+            "session_id TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (session_id, field)) WITHOUT ROWID"
+        )
+    
+    def _conn(self):
+        # sqlite3 connections are not shareable across threads; keep one per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+    
+    def _read(self, conn, session_id, fields):
+        if fields is None:
+            rows = conn.execute(
+                "SELECT field, value FROM session_fields WHERE session_id = ?", (session_id,)
+            ).fetchall()
+        else:
+            wanted = list(dict.fromkeys(['id', *fields]))
+            rows = conn.execute(
+                f"SELECT field, value FROM session_fields WHERE session_id = ? "
+                f"AND field IN ({','.join('?' * len(wanted))})",
+                (session_id, *wanted)
+            ).fetchall()
+        values = {field: json_codec.loads(value) for field, value in rows}
+        if 'id' not in values:
+            return None
+        if fields is None:
+            return values
+        return {field: values.get(field) for field in fields}
+    
+    def _write(self, conn, session_id, fields):
+        conn.executemany(
+            "INSERT OR REPLACE INTO session_fields (session_id, field, value) VALUES (?, ?, ?)",
+            [(session_id, field, _encode_field(value)) for field, value in fields.items()]
+        )
+    
+    def create(self, session_id, fields):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM session_fields WHERE session_id = ?", (session_id,))
+            self._write(conn, session_id, fields)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def load(self, session_id, fields=None):
+        return self._read(self._conn(), session_id, fields)
+    
+    def save(self, session_id, fields):
+        return self.transaction(session_id, [], lambda _: fields) is not None
+    
+    def transaction(self, session_id, fields, fn):
+        """Atomically read `fields`, apply fn, and save the dict of changes it returns"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")  # Takes the write lock up front
+        try:
+            current = self._read(conn, session_id, fields)
+            if current is None:
+                conn.execute("ROLLBACK")
+                return None
+            changes = fn(current)
+            if changes:
+                self._write(conn, session_id, changes)
+            conn.execute("COMMIT")
+            return changes
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def delete(self, session_id):
+        self._conn().execute("DELETE FROM session_fields WHERE session_id = ?", (session_id,))
+    
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM session_fields WHERE field = 'id'").fetchone()[0]
+    
+    def session_ids(self):
+        rows = self._conn().execute("SELECT session_id FROM session_fields WHERE field = 'id'").fetchall()
+        return [row[0] for row in rows]
+
+class RESPConnection:
+    """Minimal RESP2 client, enough to talk to Redis or any Redis-compatible server"""
+    
+    def __init__(self, url, timeout=5):
+        parsed = urlparse(url)
+        self._sock = socket.create_connection((parsed.hostname or 'localhost', parsed.port or 6379), timeout=timeout)
+        self._reader = self._sock.makefile('rb')
+        if parsed.password:
+            self.execute('AUTH', parsed.password)
+        db = (parsed.path or '/0').lstrip('/') or '0'
+        if db != '0':
+            self.execute('SELECT', db)
+    
+    def execute(self, *args):
+        command = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            command.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        self._sock.sendall(b''.join(command))
+        return self._read_reply()
+    
+    def close(self):
+        """Close the socket; the server drops any WATCH or open MULTI with it"""
+        try:
+            self._reader.close()
+            self._sock.close()
+        except OSError:
+            pass
+    
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by session store server")
+        kind, body = line[:1], line[1:-2]
+        if kind == b'+':
+            return body.decode('utf-8')
+        if kind == b'-':
+            raise APIError(f"Session store error: {body.decode('utf-8')}")
+        if kind == b':':
+            return int(body)
+        if kind == b'$':
+            length = int(body)
+            if length == -1:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2].decode('utf-8')
+        if kind == b'*':
+            length = int(body)
+            if length == -1:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise APIError(f"Unexpected reply from session store: {line!r}")
+
+class RedisSessionStore:
+    """Session store on a Redis-compatible server; one hash per session"""
+    
+    KEY_PREFIX = 'alp3:session:'
+    INDEX_KEY = 'alp3:sessions'
+    
+    def __init__(self, url):
+        self.url = url
+        self._local = threading.local()
+    
+    def _conn(self):
+        # WATCH/MULTI state is per connection, so each thread gets its own
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = RESPConnection(self.url)
+            self._local.conn = conn
+        return conn
+    
+    @contextmanager
+    def _connection(self):
+        """
+        This thread's connection. Any error drops it: a timeout can leave part
+        of a reply unread, and a failed transaction can leave WATCH or MULTI
+        open, so the next call must start on a fresh connection.
+        """
+        conn = self._conn()
+        try:
+            yield conn
+        except BaseException:
+            self._local.conn = None
+            conn.close()
+            raise
+    
+    def _key(self, session_id):
+        return self.KEY_PREFIX + session_id
+    
+    def _hset_args(self, fields):
+        args = []
+        for field, value in fields.items():
+            args.extend([field, _encode_field(value)])
+        return args
+    
+    def _read(self, conn, session_id, fields):
+        if fields is None:
+            # Full read: every field, including the per-question "question:<id>" entries
+            flat = conn.execute('HGETALL', self._key(session_id))
+            decoded = {flat[i]: json_codec.loads(flat[i + 1]) for i in range(0, len(flat), 2)}
+            return decoded if 'id' in decoded else None
+        wanted = list(dict.fromkeys(['id', *fields]))
+        values = conn.execute('HMGET', self._key(session_id), *wanted)
+        if values[wanted.index('id')] is None:
+            return None
+        decoded = {field: json_codec.loads(value) for field, value in zip(wanted, values) if value is not None}
+        return {field: decoded.get(field) for field in fields}
+    
+    def create(self, session_id, fields):
+        with self._connection() as conn:
+            conn.execute('MULTI')
+            conn.execute('DEL', self._key(session_id))
+            conn.execute('HSET', self._key(session_id), *self._hset_args(fields))
+            conn.execute('SADD', self.INDEX_KEY, session_id)
+            conn.execute('EXEC')
+    
+    def load(self, session_id, fields=None):
+        with self._connection() as conn:
+            return self._read(conn, session_id, fields)
+    
+    def save(self, session_id, fields):
+        return self.transaction(session_id, [], lambda _: fields) is not None
+    
+    def transaction(self, session_id, fields, fn):
+        """
+        Optimistic read-modify-write with WATCH/MULTI/EXEC; fn may run more than once.
+        If anything raises (fn included), the connection is closed rather than
+        cleaned up with UNWATCH/DISCARD, so no cleanup command can mask the error.
+        """
+        key = self._key(session_id)
+        with self._connection() as conn:
+            while True:
+                conn.execute('WATCH', key)
+                current = self._read(conn, session_id, fields)
+                if current is None:
+                    conn.execute('UNWATCH')
+                    return None
+                changes = fn(current)
+                if not changes:
+                    conn.execute('UNWATCH')
+                    return changes
+                conn.execute('MULTI')
+                conn.execute('HSET', key, *self._hset_args(changes))
+                if conn.execute('EXEC') is not None:
+                    return changes
+    
+    def delete(self, session_id):
+        with self._connection() as conn:
+            conn.execute('DEL', self._key(session_id))
+            conn.execute('SREM', self.INDEX_KEY, session_id)
+    
+    def count(self):
+        with self._connection() as conn:
+            return conn.execute('SCARD', self.INDEX_KEY)
+    
+    def session_ids(self):
+        with self._connection() as conn:
+            return conn.execute('SMEMBERS', self.INDEX_KEY)
+
+def create_session_store():
+    """Build the session store selected by Config.SESSION_STORE"""
+    if Config.SESSION_STORE == 'sqlite':
+        return SQLiteSessionStore(Config.SESSION_STORE_PATH)
+    if Config.SESSION_STORE == 'redis':
+        return RedisSessionStore(Config.SESSION_STORE_URL)
+    return MemorySessionStore()
+
+session_store = create_session_store()
+
+# ------------------------------------------------------------------
+#  RATE LIMITING: sliding-window counters per route and client
+# ------------------------------------------------------------------
+# Each key keeps two counters, the current and the previous fixed window. The
+# previous one is weighted by how much of it still overlaps the sliding
+# window, which approximates a true sliding log in O(1) memory per key.
+def parse_rate_limits(spec):
+    """Parse "route=requests/seconds,..." into {route: (requests, seconds)}"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        try:
+            route, rule = item.split('=')
+            requests_allowed, seconds = rule.split('/')
+            limits[route.strip()] = (int(requests_allowed), float(seconds))
+        except ValueError:
+            raise ValueError(f"Invalid RATE_LIMITS entry: {item!r}")
+    return limits
+
+class MemoryRateLimitBackend:
+    """Window counters for this process; least recently used keys are evicted past max_keys"""
+    
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._counters = OrderedDict()  # key -> [window index, current count, previous count]
+        self.evictions = 0
+    
+    def hit(self, key, window_index, window_seconds):
+        """Count a request; returns (current, previous) window counts"""
+        with self._lock:
+            entry = self._counters.get(key)
+            if entry is None:
+                entry = self._counters[key] = [window_index, 0, 0]
+                if len(self._counters) > self.max_keys:
+                    self._counters.popitem(last=False)
+                    self.evictions += 1
+            else:
+                self._counters.move_to_end(key)
+            if entry[0] != window_index:
+                entry[2] = entry[1] if entry[0] == window_index - 1 else 0
+                entry[0], entry[1] = window_index, 0
+            entry[1] += 1
+            return entry[1], entry[2]
+    
+    def undo(self, key, window_index):
+        """Take back a rejected request so it does not count against the client"""
+        with self._lock:
+            entry = self._counters.get(key)
+            if entry is not None and entry[0] == window_index:
+                entry[1] -= 1
+    
+    def get_stats(self):
+        with self._lock:
+            return {"backend": "memory", "keys": len(self._counters), "max_keys": self.max_keys,
+                    "evictions": self.evictions}
+
+class RedisRateLimitBackend:
+    """Window counters shared by every worker through a Redis-compatible server; idle keys expire"""
+    
+    KEY_PREFIX = 'alp3:ratelimit:'
+    
+    def __init__(self, url):
+        self.url = url
+        self._local = threading.local()
+    
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = RESPConnection(self.url)
+            self._local.conn = conn
+        return conn
+    
+    def hit(self, key, window_index, window_seconds):
+        current_key = f"{self.KEY_PREFIX}{key}:{window_index}"
+        conn = self._conn()
+        try:
+            conn.execute('MULTI')
+            conn.execute('INCR', current_key)
+            conn.execute('EXPIRE', current_key, int(math.ceil(window_seconds * 2)))
+            conn.execute('GET', f"{self.KEY_PREFIX}{key}:{window_index - 1}")
+            current, _, previous = conn.execute('EXEC')
+        except Exception:
+            self._local.conn = None  # Reconnect on the next call
+            conn.close()
+            raise
+        return current, int(previous or 0)
+    
+    def undo(self, key, window_index):
+        self._conn().execute('DECR', f"{self.KEY_PREFIX}{key}:{window_index}")
     
-    # Normalize correct_answer
-    if 'correct_answer' in question:
-        question['correct_answer'] = question['correct_answer'].upper()
+    def get_stats(self):
+        return {"backend": "redis"}
+
+class RateLimiter:
+    """Per-route sliding-window limits keyed by client address"""
     
-    return question
+    def __init__(self, backend, limits):
+        self.backend = backend
+        self.limits = limits
+        self._lock = threading.Lock()
+        self.allowed = defaultdict(int)
+        self.rejected = defaultdict(int)
+        self.backend_errors = 0
+    
+    def allow(self, route, client_key, now=None):
+        """Count a request and say whether it is within the route's limit; unlimited routes always pass"""
+        limit = self.limits.get(route)
+        if limit is None:
+            return True
+        max_requests, window_seconds = limit
+        now = time.time() if now is None else now
+        window_index = int(now // window_seconds)
+        key = f"{route}:{client_key}"
+        try:
+            current, previous = self.backend.hit(key, window_index, window_seconds)
+            overlap = 1.0 - (now % window_seconds) / window_seconds
+            within = previous * overlap + current <= max_requests
+            if not within:
+                self.backend.undo(key, window_index)
+        except Exception as e:
+            # A rate limiter outage must not take the API down with it
+            logger.warning(f"Rate limiter backend error, allowing request: {e}")
+            with self._lock:
+                self.backend_errors += 1
+            return True
+        with self._lock:
+            (self.allowed if within else self.rejected)[route] += 1
+        return within
+    
+    def get_stats(self):
+        with self._lock:
+            return {
+                **self.backend.get_stats(),
+                "limits": {route: f"{requests_allowed}/{seconds:g}s" for route, (requests_allowed, seconds) in self.limits.items()},
+                "allowed": dict(self.allowed),
+                "rejected": dict(self.rejected),
+                "backend_errors": self.backend_errors
+            }
 
-def shuffle_question_options(question):
-    """Shuffle options randomly and update correct_answer accordingly"""
-    if 'options' not in question or 'correct_answer' not in question:
-        return question
+def create_rate_limiter():
+    """Build the rate limiter selected by Config.RATE_LIMIT_BACKEND"""
+    if Config.RATE_LIMIT_BACKEND == 'redis':
+        backend = RedisRateLimitBackend(Config.RATE_LIMIT_URL)
+    else:
+        backend = MemoryRateLimitBackend(Config.RATE_LIMIT_MAX_KEYS)
+    return RateLimiter(backend, parse_rate_limits(Config.RATE_LIMITS))
+
+rate_limiter = create_rate_limiter()
+
+def client_address():
+    """Address rate limits are keyed by"""
+    return request.environ.get('HTTP_X_FORWARDED_FOR', request.environ.get('REMOTE_ADDR', 'unknown'))
+
+def check_rate_limit(client_ip, route='session_create'):
+    """Check if client is within the route's rate limit (session creation by default)"""
+    return rate_limiter.allow(route, client_ip)
+
+def load_session(session_id, fields=None):
+    """Load session fields or raise 404"""
+    session = session_store.load(session_id, fields)
+    if session is None:
+        raise APIError("Session not found", 404)
+    return session
+# ------------------------------------------------------------------
+
+class SessionExpiryIndex:
+    """Min-heap of session deadlines keyed on last activity, with lazy invalidation"""
     
-    # Create a copy to avoid modifying the original
-    shuffled_question = copy.deepcopy(question)
+    def __init__(self, timeout_seconds):
+        self.timeout_seconds = timeout_seconds
+        self._heap = []            # (last_activity, session_id); stale entries are skipped on pop
+        self._last_activity = {}   # session_id -> latest known activity
+        self._lock = threading.Lock()
     
-    # Get the correct answer text
-    correct_text = shuffled_question['options'][shuffled_question['correct_answer']]
+    def touch(self, session_id, at=None):
+        """Record activity for a session: O(log n)"""
+        at = time.time() if at is None else at
+        with self._lock:
+            if at <= self._last_activity.get(session_id, 0):
+                return
+            self._last_activity[session_id] = at
+            heapq.heappush(self._heap, (at, session_id))
     
-    # Create list of option texts
-    option_texts = [
-        shuffled_question['options']['A'],
-        shuffled_question['options']['B'], 
-        shuffled_question['options']['C'],
-        shuffled_question['options']['D']
-    ]
+    def forget(self, session_id):
+        with self._lock:
+            self._last_activity.pop(session_id, None)
     
-    # Shuffle the texts
-    random.shuffle(option_texts)
+    def pop_expired(self, now):
+        """Remove and return (session_id, last_activity) for every session idle past the timeout"""
+        cutoff = now - self.timeout_seconds
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= cutoff:
+                at, session_id = heapq.heappop(self._heap)
+                if self._last_activity.get(session_id) == at:
+                    del self._last_activity[session_id]
+                    expired.append((session_id, at))
+            # Rebuild if superseded entries dominate the heap
+            if len(self._heap) > 2 * len(self._last_activity) + 64:
+                self._heap = [(at, sid) for sid, at in self._last_activity.items()]
+                heapq.heapify(self._heap)
+        return expired
     
-    # Reassign to A, B, C, D
-    shuffled_question['options'] = {
-        'A': option_texts[0],
-        'B': option_texts[1],
-        'C': option_texts[2],
-        'D': option_texts[3]
-    }
+    def __len__(self):
+        return len(self._last_activity)
+
+class SessionReaper:
+    """Background thread that deletes sessions idle longer than SESSION_TIMEOUT_HOURS"""
     
-    # Find new position of correct answer
-    for key, text in shuffled_question['options'].items():
-        if text == correct_text:
-            shuffled_question['correct_answer'] = key
-            break
+    def __init__(self, index, interval_seconds):
+        self.index = index
+        self.interval_seconds = interval_seconds
+        self.runs = 0
+        self.sessions_reaped = 0
+        self.last_reaped = 0
+        self.last_duration_ms = 0.0
+        self.max_duration_ms = 0.0
+        self._thread = None
+        self._start_lock = threading.Lock()
     
-    # Update explanations to match new positions
-    if 'explanations' in shuffled_question:
-        old_explanations = shuffled_question['explanations'].copy()
-        new_explanations = {}
-        
-        # Map explanations to new positions
-        for new_key, text in shuffled_question['options'].items():
-            # Find which old key had this text
-            for old_key, old_text in question['options'].items():
-                if old_text == text and old_key in old_explanations:
-                    new_explanations[new_key] = old_explanations[old_key]
-                    break
-        
-        # Ensure correct explanation is updated
-        if 'correct' in old_explanations:
-            new_explanations['correct'] = old_explanations['correct']
+    def start(self):
+        """Start the reaper once; seeds the index from sessions already in a persistent store"""
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="session-reaper", daemon=True)
+        for session_id in session_store.session_ids():
+            session = session_store.load(session_id, ['last_activity'])
+            if session is not None:
+                self.index.touch(session_id, session['last_activity'] or time.time())
+        self._thread.start()
+    
+    def _run(self):
+        while True:
+            time.sleep(self.interval_seconds)
+            try:
+                self.reap_once()
+            except Exception as e:
+                logger.error(f"Session reaper error: {e}")
+    
+    def reap_once(self):
+        start = time.perf_counter()
+        now = time.time()
+        reaped = 0
+        for session_id, known_activity in self.index.pop_expired(now):
+            # Another worker process may have seen newer activity for this session
+            session = session_store.load(session_id, ['last_activity'])
+            if session is None:
+                continue
+            last_activity = session['last_activity'] or known_activity
+            if now - last_activity < self.index.timeout_seconds:
+                self.index.touch(session_id, last_activity)
+                continue
+            session_store.delete(session_id)
+            session_work.cancel(session_id)
+            reaped += 1
+            logger.info(f"Cleaned up expired session: {session_id}")
         
-        shuffled_question['explanations'] = new_explanations
+        duration_ms = (time.perf_counter() - start) * 1000
+        self.runs += 1
+        self.sessions_reaped += reaped
+        self.last_reaped = reaped
+        self.last_duration_ms = round(duration_ms, 3)
+        self.max_duration_ms = max(self.max_duration_ms, self.last_duration_ms)
+        return reaped
     
-    return shuffled_question
+    def get_stats(self):
+        return {
+            "tracked_sessions": len(self.index),
+            "runs": self.runs,
+            "sessions_reaped": self.sessions_reaped,
+            "last_reaped": self.last_reaped,
+            "last_duration_ms": self.last_duration_ms,
+            "max_duration_ms": self.max_duration_ms
+        }
 
-def call_openai_api(prompt, system_message=None, temperature=0.3, max_retries=3, response_format=None):
-    """Call OpenAI API with improved parameters and error handling"""
-    headers = {
-        'Authorization': f'Bearer {Config.OPENAI_API_KEY}',
-        'Content-Type': 'application/json'
-    }
+session_reaper = SessionReaper(
+    SessionExpiryIndex(Config.SESSION_TIMEOUT_HOURS * 3600),
+    Config.SESSION_REAP_INTERVAL_SECONDS
+)
+
+def touch_session(session_id, at=None):
+    """Record session activity in the expiry index"""
+    session_reaper.index.touch(session_id, at)
+
+def forget_session(session_id):
+    """Stop tracking a session that was deleted outside the reaper"""
+    session_reaper.index.forget(session_id)
+
+class PDFExtractionStats:
+    """Per-page timing counters for PDF text extraction"""
     
-    messages = []
-    if system_message:
-        messages.append({'role': 'system', 'content': system_message})
-    messages.append({'role': 'user', 'content': prompt})
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.documents = 0
+        self.pages = 0
+        self.early_stops = 0
+        self.total_page_ms = 0.0
+        self.max_page_ms = 0.0
+        self.last_document_ms = 0.0
     
-    data = {
-        'model': Config.OPENAI_MODEL,  # Configurable model from environment
-        'messages': messages,
-        'temperature': temperature,
-        'max_tokens': 4096  # Appropriate for gpt-3.5-turbo
-    }
+    def record_pages(self, page_timings_ms):
+        with self._lock:
+            self.pages += len(page_timings_ms)
+            self.total_page_ms += sum(page_timings_ms)
+            self.max_page_ms = max([self.max_page_ms, *page_timings_ms])
     
-    # Add response format if specified
-    if response_format:
-        data['response_format'] = response_format
+    def record_document(self, duration_ms, stopped_early):
+        with self._lock:
+            self.documents += 1
+            self.early_stops += int(stopped_early)
+            self.last_document_ms = round(duration_ms, 3)
     
-    for attempt in range(max_retries):
-        try:
-            logger.info(f"Making OpenAI API call (attempt {attempt + 1}) with model {Config.OPENAI_MODEL}")
-            response = requests.post(
-                Config.OPENAI_API_URL, 
-                headers=headers, 
-                json=data, 
-                timeout=60  # Standard timeout for gpt-3.5-turbo
-            )
-            response.raise_for_status()
-            
-            result = response.json()
-            content = result['choices'][0]['message']['content']
-            
-            logger.info("OpenAI API call successful")
-            return content
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"OpenAI API request error (attempt {attempt + 1}): {e}")
-            if attempt == max_retries - 1:
-                raise APIError(f"OpenAI API request failed after {max_retries} attempts: {str(e)}")
-        except KeyError as e:
-            logger.error(f"OpenAI API response format error: {e}")
-            raise APIError("Invalid response format from OpenAI API")
-        except Exception as e:
-            logger.error(f"Unexpected error in OpenAI API call: {e}")
-            if attempt == max_retries - 1:
-                raise APIError(f"OpenAI API call failed: {str(e)}")
+    def get_stats(self):
+        with self._lock:
+            return {
+                "documents": self.documents,
+                "pages": self.pages,
+                "early_stops": self.early_stops,
+                "avg_page_ms": round(self.total_page_ms / self.pages, 3) if self.pages else 0.0,
+                "max_page_ms": round(self.max_page_ms, 3),
+                "last_document_ms": self.last_document_ms
+            }
 
-def cleanup_expired_sessions():
-    """Remove expired sessions to prevent memory leaks"""
-    current_time = datetime.now()
-    expired_sessions = []
-    
-    for session_id, session in sessions.items():
-        session_time = session.get('created_at', current_time)
-        if current_time - session_time > timedelta(hours=Config.SESSION_TIMEOUT_HOURS):
-            expired_sessions.append(session_id)
+pdf_stats = PDFExtractionStats()
+pdf_process_pool = None
+
+def _extract_page_range(file_content, start, end, max_chars=None):
+    """Process-pool worker: extract pages [start, end) and time each one, stopping once max_chars is reached"""
+    pdf_reader = PyPDF2.PdfReader(BytesIO(file_content))
+    results = []
+    collected = 0
+    for page_number in range(start, end):
+        page_start = time.perf_counter()
+        text = pdf_reader.pages[page_number].extract_text() or ""
+        results.append((text, (time.perf_counter() - page_start) * 1000))
+        collected += len(text) + 1
+        if max_chars is not None and collected >= max_chars:
+            break
+    return results
+
+def iter_pdf_pages(pdf_reader):
+    """Lazily yield (page_text, elapsed_ms) one page at a time"""
+    for page in pdf_reader.pages:
+        page_start = time.perf_counter()
+        text = page.extract_text() or ""
+        yield text, (time.perf_counter() - page_start) * 1000
+
+def _extract_pages_in_pool(file_content, page_count, max_chars=None):
+    """
+    Extract pages across the process pool, preserving page order. Closing the
+    generator (the caller has enough text) cancels ranges not yet started.
+    """
+    global pdf_process_pool
+    if pdf_process_pool is None:
+        pdf_process_pool = ProcessPoolExecutor(max_workers=Config.PDF_EXTRACT_WORKERS)
     
-    for session_id in expired_sessions:
-        del sessions[session_id]
-        logger.info(f"Cleaned up expired session: {session_id}")
+    step = Config.PDF_PAGES_PER_WORKER_TASK
+    futures = [
+        pdf_process_pool.submit(_extract_page_range, file_content, start, min(start + step, page_count), max_chars)
+        for start in range(0, page_count, step)
+    ]
+    try:
+        for future in futures:
+            yield from future.result()
+    finally:
+        for future in futures:
+            future.cancel()
 
-def extract_pdf_text(file_content):
-    """Extract text from PDF file content"""
+@timed_stage("pdf_extract")
+def extract_pdf_text(file_content, max_chars=None):
+    """
+    Extract text from PDF file content.
+    With max_chars, extraction stops as soon as enough text is available.
+    Large documents are split across a process pool when PDF_EXTRACT_WORKERS > 1;
+    each worker also stops at max_chars, and unstarted ranges are cancelled.
+    """
+    document_start = time.perf_counter()
     try:
         pdf_reader = PyPDF2.PdfReader(BytesIO(file_content))
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        return text.strip()
+        page_count = len(pdf_reader.pages)
+        
+        use_pool = Config.PDF_EXTRACT_WORKERS > 1 and page_count > Config.PDF_PAGES_PER_WORKER_TASK
+        pages = (_extract_pages_in_pool(file_content, page_count, max_chars) if use_pool
+                 else iter_pdf_pages(pdf_reader))
+        
+        parts = []
+        timings = []
+        collected = 0
+        stopped_early = False
+        try:
+            for text, elapsed_ms in pages:
+                parts.append(text)
+                timings.append(elapsed_ms)
+                collected += len(text) + 1
+                if max_chars is not None and collected >= max_chars:
+                    stopped_early = len(timings) < page_count
+                    break
+        finally:
+            pages.close()
+        
+        pdf_stats.record_pages(timings)
+        pdf_stats.record_document((time.perf_counter() - document_start) * 1000, stopped_early)
+        return "\n".join(parts).strip()
     except Exception as e:
         logger.error(f"PDF extraction error: {e}")
         raise APIError("Failed to extract text from PDF file")
 
+# ------------------------------------------------------------------
+#  DOCUMENT CHUNKING + LOCAL TF-IDF RETRIEVAL FOR PDF SESSIONS
+# ------------------------------------------------------------------
+STOPWORDS = frozenset("""
+    the and for are but not you all any can had her was one our out has him his how its may new now
+    see two who did get let put say she too use that with have this will your from they know want been
+    good much some time very when come here just like long make many more only over such take than them
+    well were what which while into also each other their there these those then would could should
+    about after again being below between both during further most same through under until upon where
+    because before above does doing off own once why whom yet per via within without
+""".split())
+TOKEN_PATTERN = re.compile(r"[a-z][a-z0-9\-]{2,}")
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+def chunk_document(text, target_chars=None):
+    """Split document text into roughly target-sized chunks along paragraph and sentence boundaries"""
+    target_chars = target_chars or Config.PDF_CHUNK_CHARS
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()]
+    if len(paragraphs) <= 1:
+        # PDF extraction often loses blank lines; fall back to line breaks
+        paragraphs = [p.strip() for p in text.split("\n") if p.strip()]
+    
+    chunks = []
+    current = []
+    current_len = 0
+    for paragraph in paragraphs:
+        pieces = [paragraph]
+        if len(paragraph) > target_chars:
+            pieces = [s for s in re.split(r"(?<=[.!?])\s+", paragraph) if s]
+        for piece in pieces:
+            if current and current_len + len(piece) > target_chars:
+                chunks.append(" ".join(current))
+                current, current_len = [], 0
+            # Hard-wrap anything that still does not fit (e.g. text without punctuation)
+            while len(piece) > target_chars:
+                chunks.append(piece[:target_chars])
+                piece = piece[target_chars:]
+            current.append(piece)
+            current_len += len(piece) + 1
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+class DocumentIndex:
+    """Lightweight TF-IDF index over the chunks of one document"""
+    
+    def __init__(self, text):
+        self.chunks = chunk_document(text)
+        self.title = next((line.strip() for line in text.split("\n") if line.strip()), "Uploaded document")[:80]
+        
+        term_counts = [defaultdict(int) for _ in self.chunks]
+        document_frequency = defaultdict(int)
+        for counts, chunk in zip(term_counts, self.chunks):
+            for token in tokenize(chunk):
+                counts[token] += 1
+            for token in counts:
+                document_frequency[token] += 1
+        
+        total = len(self.chunks)
+        self.idf = {token: math.log((1 + total) / (1 + df)) + 1 for token, df in document_frequency.items()}
+        self.vectors = []
+        for counts in term_counts:
+            vector = {token: (1 + math.log(count)) * self.idf[token] for token, count in counts.items()}
+            norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+            self.vectors.append({token: weight / norm for token, weight in vector.items()})
+    
+    def search(self, query, k):
+        """Indices of the k chunks most similar to the query, best first"""
+        query_terms = set(tokenize(query))
+        scored = []
+        for index, vector in enumerate(self.vectors):
+            score = sum(vector.get(term, 0.0) * self.idf.get(term, 0.0) for term in query_terms)
+            if score > 0:
+                scored.append((score, index))
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [index for _, index in scored[:k]]
+    
+    def top_terms(self, chunk_indices, n):
+        """Highest-weighted terms across a group of chunks"""
+        weights = defaultdict(float)
+        for index in chunk_indices:
+            for token, weight in self.vectors[index].items():
+                weights[token] += weight
+        return [token for token, _ in sorted(weights.items(), key=lambda item: -item[1])[:n]]
+    
+    def outline(self, max_chars):
+        """Section-by-section summary covering the whole document within max_chars"""
+        if not self.chunks:
+            return ""
+        section_count = min(Config.PDF_OUTLINE_SECTIONS, len(self.chunks))
+        per_section = max(80, max_chars // section_count - 60)
+        bounds = [round(i * len(self.chunks) / section_count) for i in range(section_count + 1)]
+        lines = []
+        for number in range(section_count):
+            section = range(bounds[number], bounds[number + 1])
+            keywords = ", ".join(self.top_terms(section, 6))
+            excerpt = self.chunks[section[0]][:per_section]
+            lines.append(f"Section {number + 1} [{keywords}]: {excerpt}")
+        return "\n".join(lines)[:max_chars]
+    
+    def concept_context(self, learning_progression, max_chars):
+        """Most relevant excerpts for each concept, sharing one character budget"""
+        if not self.chunks or not learning_progression:
+            return []
+        per_concept = max(200, max_chars // len(learning_progression))
+        per_chunk = per_concept // Config.PDF_CONCEPT_CHUNKS
+        context = []
+        for concept in learning_progression:
+            query = f"{concept.get('concept_name', '')} {concept.get('description', '')}"
+            excerpts = [self.chunks[i][:per_chunk] for i in self.search(query, Config.PDF_CONCEPT_CHUNKS)]
+            if excerpts:
+                context.append({"concept_id": concept.get("concept_id"), "excerpts": excerpts})
+        return context
+# ------------------------------------------------------------------
+
 class StudyPlanGenerator:
     """Generates progressive learning plans from topics or content"""
     
+    @timed_stage("study_plan")
     def create_study_plan(self, topic_or_content, content_type="topic"):
         """Create a progressive study plan with building concepts"""
         
-        # Sanitize input
         topic_or_content = sanitize_input(topic_or_content)
+        cache_key = GenerationCache.make_key("study_plan", *content_cache_identity(topic_or_content, content_type))
+        cached_plan = generation_cache.get(cache_key)
+        if cached_plan:
+            return cached_plan
+        
+        def generate():
+            document = None
+            try:
+                # Only the leader of a cache miss pays for indexing the document
+                prompt, system_message, document = self._prepare_study_plan_request(topic_or_content, content_type)
+                response = call_openai_api(
+                    prompt, 
+                    system_message=system_message,
+                    temperature=0.3,
+                    response_format={"type": "json_object"},
+                    call_type="study_plan"
+                )
+                return self._finish_study_plan(response, topic_or_content, cache_key, document)
+                
+            except Exception as e:
+                logger.error(f"Study plan generation error: {e}")
+                return self._fallback_study_plan(topic_or_content, document)
+        
+        return single_flight.do(cache_key, generate)
+    
+    @timed_stage("study_plan")
+    async def create_study_plan_async(self, topic_or_content, content_type="topic", use_cache=True):
+        """Event-loop variant of create_study_plan using async_call_openai_api"""
+        
+        topic_or_content = sanitize_input(topic_or_content)
+        cache_key = GenerationCache.make_key("study_plan", *content_cache_identity(topic_or_content, content_type))
+        cached_plan = generation_cache.get(cache_key) if use_cache else None
+        if cached_plan:
+            return cached_plan
+        
+        async def generate():
+            document = None
+            try:
+                prompt, system_message, document = self._prepare_study_plan_request(topic_or_content, content_type)
+                response = await async_call_openai_api(
+                    prompt, 
+                    system_message=system_message,
+                    temperature=0.3,
+                    response_format={"type": "json_object"},
+                    call_type="study_plan"
+                )
+                return self._finish_study_plan(response, topic_or_content, cache_key, document)
+                
+            except Exception as e:
+                logger.error(f"Study plan generation error: {e}")
+                return self._fallback_study_plan(topic_or_content, document)
+        
+        return await single_flight.do_async(cache_key, generate)
+    
+    def _prepare_study_plan_request(self, topic_or_content, content_type):
+        """Build the prompt for a study plan call from sanitized input (plus the document index for PDFs)"""
+        document = None
         
         if content_type == "topic":
             prompt = self._create_topic_study_plan_prompt(topic_or_content)
         else:  # PDF content
-            prompt = self._create_content_study_plan_prompt(topic_or_content)
+            document = DocumentIndex(topic_or_content)
+            prompt = self._create_content_study_plan_prompt(document)
         
         system_message = "You are an educational curriculum designer. Output only valid JSON matching the schema provided."
-        
+        return prompt, system_message, document
+    
+    def _finish_study_plan(self, response, topic_or_content, cache_key, document=None):
+        """Parse and validate a study plan response, caching good plans and falling back on bad output"""
         try:
-            response = call_openai_api(
-                prompt, 
-                system_message=system_message,
-                temperature=0.3,
-                response_format={"type": "json_object"}
-            )
-            study_plan = json.loads(response)
-            
-            # Validate study plan structure
-            if not self._validate_study_plan(study_plan):
-                logger.warning("Generated study plan failed validation, using fallback")
-                return self._create_fallback_plan(topic_or_content)
-            
-            logger.info(f"Successfully created study plan for: {topic_or_content[:50]}...")
-            return study_plan
-            
+            with STAGE_SECONDS.time(stage="json_parse"):
+                study_plan = json_codec.loads(response)
         except json.JSONDecodeError as e:
             logger.error(f"Study plan JSON parse error: {e}")
-            return self._create_fallback_plan(topic_or_content)
-        except Exception as e:
-            logger.error(f"Study plan generation error: {e}")
-            return self._create_fallback_plan(topic_or_content)
+            return self._fallback_study_plan(topic_or_content, document)
+        
+        # Validate study plan structure
+        if not self._validate_study_plan(study_plan):
+            logger.warning("Generated study plan failed validation, using fallback")
+            return self._fallback_study_plan(topic_or_content, document)
+        
+        if document:
+            # Question prompts draw on the excerpts most relevant to each concept
+            study_plan['source_context'] = document.concept_context(
+                study_plan['learning_progression'], Config.PDF_BATCH_CONTEXT_CHARS
+            )
+        
+        generation_cache.set(cache_key, study_plan)
+        logger.info(f"Successfully created study plan for: {topic_or_content[:50]}...")
+        return study_plan
     
     def _validate_study_plan(self, study_plan):
         """Validate study plan structure"""
@@ -384,20 +2831,54 @@ class StudyPlanGenerator:
         Create 6-10 concepts that form a logical learning progression.
         """
     
-    def _create_content_study_plan_prompt(self, content):
-        # Limit content length to prevent token overflow
-        content_preview = content[:2000] if len(content) > 2000 else content
+    def _create_content_study_plan_prompt(self, document):
+        # A section-by-section outline keeps the prompt bounded while covering the whole document
+        outline = document.outline(Config.PDF_PLAN_CONTEXT_CHARS)
         
         return f"""
-        Analyze this content and create a progressive learning study plan:
+        Analyze this document and create a progressive learning study plan.
+        The outline below summarizes every section of the document in order (key terms in brackets):
+        
+        {outline}
         
-        {content_preview}...
+        Design a sequence of concepts from this content that build on each other,
+        covering material from across the whole document, not just its opening.
         
-        Design a sequence of concepts from this content that build on each other.
+        IMPORTANT: Return ONLY valid JSON in this exact format:
+        {{
+            "topic": "{document.title}",
+            "total_concepts": 8,
+            "learning_progression": [
+                {{
+                    "concept_id": 1,
+                    "concept_name": "Basic concept name",
+                    "description": "What this concept teaches",
+                    "prerequisites": [],
+                    "builds_to": [2, 3]
+                }}
+            ],
+            "difficulty_progression": "easy_to_hard",
+            "estimated_questions": 20
+        }}
         
-        IMPORTANT: Return ONLY valid JSON in the same format as topic plans.
+        Create 6-10 concepts that form a logical learning progression.
         """
     
+    def _fallback_study_plan(self, topic_or_content, document=None):
+        """Fallback plan; PDF sessions use the document title and still get per-concept context"""
+        if not document:
+            return self._create_fallback_plan(topic_or_content)
+        study_plan = self._create_fallback_plan(document.title)
+        study_plan['source_context'] = document.concept_context(
+            study_plan['learning_progression'], Config.PDF_BATCH_CONTEXT_CHARS
+        )
+        return study_plan
+    
+    def is_fallback_plan(self, study_plan):
+        """Whether a plan is the template from _create_fallback_plan rather than a generated one"""
+        fallback = self._create_fallback_plan(study_plan.get('topic', ''))
+        return study_plan.get('learning_progression') == fallback['learning_progression']
+    
     def _create_fallback_plan(self, topic):
         """Simple fallback plan if JSON parsing fails"""
         return {
@@ -477,20 +2958,144 @@ class ProgressiveQuestionGenerator:
                 fallback_questions = self._create_fallback_questions_batch(study_plan, i*5 + 1, 5)
                 all_questions.extend(fallback_questions)
         
-        # Shuffle options for all questions
-        shuffled_questions = []
-        for question in all_questions:
-            normalized_question = normalize_option_keys(question)
-            shuffled_question = shuffle_question_options(normalized_question)
-            shuffled_questions.append(shuffled_question)
-        
-        logger.info(f"Successfully generated {len(shuffled_questions)} progressive questions in 4 batches")
-        return shuffled_questions
+        logger.info(f"Successfully generated {len(all_questions)} progressive questions in 4 batches")
+        return all_questions
     
+    @timed_stage("question_batch")
     def _generate_question_batch(self, study_plan, batch_info, start_id, system_message):
         """Generate a batch of 5 questions"""
+        prompt = self._create_batch_prompt(study_plan, batch_info, start_id)
+        cache_key = self._batch_cache_key(study_plan, batch_info, start_id)
+        cached_batch = generation_cache.get(cache_key)
+        if cached_batch:
+            return cached_batch
+        
+        def generate():
+            try:
+                response = call_openai_api(
+                    prompt, 
+                    system_message=system_message,
+                    temperature=0.3,
+                    response_format={"type": "json_object"},
+                    call_type="batch"
+                )
+                return self._finish_question_batch(response, cache_key)
+                
+            except Exception as e:
+                logger.error(f"Batch generation error: {e}")
+                return None
+        
+        return single_flight.do(cache_key, generate)
+    
+    @timed_stage("question_batch")
+    async def _generate_question_batch_async(self, study_plan, batch_info, start_id, system_message, use_cache=True):
+        """Event-loop variant of _generate_question_batch"""
+        prompt = self._create_batch_prompt(study_plan, batch_info, start_id)
+        cache_key = self._batch_cache_key(study_plan, batch_info, start_id)
+        cached_batch = generation_cache.get(cache_key) if use_cache else None
+        if cached_batch:
+            return cached_batch
+        
+        async def generate():
+            try:
+                response = await async_call_openai_api(
+                    prompt, 
+                    system_message=system_message,
+                    temperature=0.3,
+                    response_format={"type": "json_object"},
+                    call_type="batch"
+                )
+                return self._finish_question_batch(response, cache_key)
+                
+            except Exception as e:
+                logger.error(f"Batch generation error: {e}")
+                return None
+        
+        return await single_flight.do_async(cache_key, generate)
+    
+    def stream_question_batch(self, study_plan, batch_info, start_id, system_message):
+        """Yield validated questions one at a time as they are parsed from a streamed response"""
+        cache_key = self._batch_cache_key(study_plan, batch_info, start_id)
+        cached_batch = generation_cache.get(cache_key)
+        if cached_batch:
+            yield from cached_batch
+            return
+        
+        prompt = self._create_batch_prompt(study_plan, batch_info, start_id)
+        parser = StreamingQuestionParser()
+        streamed = []
+        for chunk in stream_openai_api(
+            prompt,
+            system_message=system_message,
+            temperature=0.3,
+            response_format={"type": "json_object"},
+            call_type="batch"
+        ):
+            for question in parser.feed(chunk):
+                if self._validate_question(question):
+                    question = normalize_option_keys(question)
+                    streamed.append(question)
+                    yield question
+        
+        # Only complete, well-formed batches are worth caching
+        if self._parse_question_batch(parser.text):
+            generation_cache.set(cache_key, streamed)
+    
+    def _batch_cache_key(self, study_plan, batch_info, start_id):
+        return GenerationCache.make_key("batch", study_plan_digest(study_plan), batch_info['name'], start_id)
+    
+    def _finish_question_batch(self, response, cache_key):
+        """Parse a batch response and cache it unshuffled; option order is drawn per session when staged"""
+        questions = self._parse_question_batch(response)
+        if questions:
+            generation_cache.set(cache_key, questions)
+        return questions
+    
+    def _parse_question_batch(self, response):
+        """Parse a batch response, returning validated questions or None"""
+        try:
+            with STAGE_SECONDS.time(stage="json_parse"):
+                parsed = json_codec.loads(response)
+            questions = parsed["questions"]  # Extract questions array from object
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            logger.error(f"Batch JSON parse error: {e}")
+            return None
+        
+        # Validate it's an array with 5 questions
+        if not isinstance(questions, list) or len(questions) != 5:
+            logger.warning(f"Batch returned {len(questions) if isinstance(questions, list) else 'non-array'} questions, expected 5")
+            return None
         
-        prompt = f"""
+        # Validate each question
+        validated_questions = []
+        for q in questions:
+            if self._validate_question(q):
+                validated_questions.append(normalize_option_keys(q))
+        
+        if len(validated_questions) < 3:  # Need at least 3 valid questions
+            logger.warning(f"Only {len(validated_questions)} valid questions in batch")
+            return None
+        
+        return validated_questions
+    
+    def _format_source_context(self, study_plan):
+        """Prompt section with the document excerpts retrieved for each concept (PDF sessions only)"""
+        source_context = study_plan.get('source_context')
+        if not source_context:
+            return ""
+        names = {c.get('concept_id'): c.get('concept_name') for c in study_plan['learning_progression']}
+        sections = []
+        for entry in source_context:
+            excerpts = "\n".join(f"- {excerpt}" for excerpt in entry['excerpts'])
+            sections.append(f"[Concept {entry['concept_id']}: {names.get(entry['concept_id'], '')}]\n{excerpts}")
+        return (
+            "\n        SOURCE MATERIAL (excerpts from the uploaded document; base each question on the excerpts for its concept):\n"
+            + "\n\n".join(sections) + "\n"
+        )
+    
+    def _create_batch_prompt(self, study_plan, batch_info, start_id):
+        """Build the prompt for a batch of 5 questions"""
+        return f"""
         You are creating a progressive learning experience for the topic: {study_plan['topic']}
         
         BATCH: {batch_info['name']} (Questions {batch_info['questions']})
@@ -530,7 +3135,7 @@ class ProgressiveQuestionGenerator:
         
         LEARNING PROGRESSION FOR {study_plan['topic']}:
         {json.dumps(study_plan['learning_progression'], indent=2)}
-        
+        {self._format_source_context(study_plan)}
         QUESTION STYLE EXAMPLES FOR INSPIRATION:
         - "A scientist observes that [specific scenario]. What explains this phenomenon?"
         - "If [specific condition] occurs, which outcome is most likely?"
@@ -579,41 +3184,6 @@ class ProgressiveQuestionGenerator:
         
         Generate exactly 5 questions for the {batch_info['name']} batch that match the quality and style of the Bio 1 example.
         """
-        
-        try:
-            response = call_openai_api(
-                prompt, 
-                system_message=system_message,
-                temperature=0.3,
-                response_format={"type": "json_object"}
-            )
-            
-            parsed = json.loads(response)
-            questions = parsed["questions"]  # Extract questions array from object
-            
-            # Validate it's an array with 5 questions
-            if not isinstance(questions, list) or len(questions) != 5:
-                logger.warning(f"Batch returned {len(questions) if isinstance(questions, list) else 'non-array'} questions, expected 5")
-                return None
-            
-            # Validate each question
-            validated_questions = []
-            for q in questions:
-                if self._validate_question(q):
-                    validated_questions.append(q)
-            
-            if len(validated_questions) < 3:  # Need at least 3 valid questions
-                logger.warning(f"Only {len(validated_questions)} valid questions in batch")
-                return None
-            
-            return validated_questions
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"Batch JSON parse error: {e}")
-            return None
-        except Exception as e:
-            logger.error(f"Batch generation error: {e}")
-            return None
     
     def _create_fallback_questions_batch(self, study_plan, start_id, count):
         """Create fallback questions for a batch"""
@@ -653,14 +3223,148 @@ class ProgressiveQuestionGenerator:
         """Generate mastery questions for a concept the student got wrong"""
         
         system_message = "You are an assessment engine. Output only valid JSON matching the schema the user provides, no prose."
+        prompt = self._create_mastery_prompt(failed_concept, original_question, count)
         
-        prompt = f"""
-        The student got this question wrong: {original_question['question']}
-        Correct answer was: {original_question['correct_answer']}
-        Concept: {failed_concept}
+        def generate():
+            try:
+                response = call_openai_api(
+                    prompt, 
+                    system_message=system_message,
+                    temperature=0.3,
+                    response_format={"type": "json_object"},
+                    call_type="mastery"
+                )
+                return self._parse_mastery_questions(response, failed_concept, count)
+                
+            except Exception as e:
+                logger.error(f"Mastery questions generation error: {e}")
+                return self._create_fallback_mastery_questions(failed_concept, count)
+        
+        return single_flight.do(self._mastery_flight_key(failed_concept, original_question, count), generate)
+    
+    async def generate_mastery_questions_async(self, failed_concept, original_question, count=5):
+        """Event-loop variant of generate_mastery_questions"""
+        
+        system_message = "You are an assessment engine. Output only valid JSON matching the schema the user provides, no prose."
+        prompt = self._create_mastery_prompt(failed_concept, original_question, count)
+        
+        async def generate():
+            try:
+                response = await async_call_openai_api(
+                    prompt, 
+                    system_message=system_message,
+                    temperature=0.3,
+                    response_format={"type": "json_object"},
+                    call_type="mastery"
+                )
+                return self._parse_mastery_questions(response, failed_concept, count)
+                
+            except Exception as e:
+                logger.error(f"Mastery questions generation error: {e}")
+                return self._create_fallback_mastery_questions(failed_concept, count)
+        
+        return await single_flight.do_async(self._mastery_flight_key(failed_concept, original_question, count), generate)
+    
+    async def generate_mastery_questions_for_misses_async(self, misses, count=5):
+        """
+        Mastery questions for several missed concepts, as {concept: questions}.
+        Up to MASTERY_BATCH_MAX_CONCEPTS concepts share one call.
+        """
+        size = max(1, Config.MASTERY_BATCH_MAX_CONCEPTS)
+        chunks = [misses[i:i + size] for i in range(0, len(misses), size)]
+        results = await asyncio.gather(*(self._generate_mastery_chunk_async(chunk, count) for chunk in chunks))
+        return {concept: questions for result in results for concept, questions in result.items()}
+    
+    async def _generate_mastery_chunk_async(self, misses, count):
+        if len(misses) == 1:
+            concept, original_question = misses[0]
+            return {concept: await self.generate_mastery_questions_async(concept, original_question, count)}
+        
+        system_message = "You are an assessment engine. Output only valid JSON matching the schema the user provides, no prose."
+        prompt = self._create_multi_mastery_prompt(misses, count)
+        
+        async def generate():
+            try:
+                response = await async_call_openai_api(
+                    prompt, 
+                    system_message=system_message,
+                    temperature=0.3,
+                    response_format={"type": "json_object"},
+                    call_type="mastery_batch"
+                )
+                return self._parse_multi_mastery_questions(response, misses, count)
+                
+            except Exception as e:
+                logger.error(f"Batched mastery questions generation error: {e}")
+                return {concept: self._create_fallback_mastery_questions(concept, count) for concept, _ in misses}
+        
+        key = GenerationCache.make_key(
+            "mastery", [[concept, original_question['question']] for concept, original_question in misses], count
+        )
+        return await single_flight.do_async(key, generate)
+    
+    def _mastery_flight_key(self, failed_concept, original_question, count):
+        """Students who miss the same question on the same concept share one mastery call"""
+        return GenerationCache.make_key("mastery", failed_concept, original_question['question'], count)
+    
+    def _parse_mastery_questions(self, response, failed_concept, count):
+        """Parse, validate, normalize and shuffle a mastery response"""
+        try:
+            with STAGE_SECONDS.time(stage="json_parse"):
+                parsed = json_codec.loads(response)
+            mastery_questions = parsed["questions"]  # Extract questions array from object
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            logger.error(f"Mastery questions JSON error: {e}")
+            return self._create_fallback_mastery_questions(failed_concept, count)
+        
+        validated_questions = self._validated_mastery_questions(mastery_questions)
+        if not validated_questions:
+            logger.warning("No valid mastery questions generated, using fallback")
+            return self._create_fallback_mastery_questions(failed_concept, count)
+        
+        logger.info(f"Successfully generated {len(validated_questions)} mastery questions")
+        return validated_questions
+    
+    def _validated_mastery_questions(self, mastery_questions):
+        """Validate and normalize the questions of one mastery set"""
+        # Ensure it's a list
+        if not isinstance(mastery_questions, list):
+            mastery_questions = [mastery_questions] if mastery_questions else []
+        
+        validated_questions = []
+        for mq in mastery_questions:
+            if isinstance(mq, dict) and self._validate_question(mq):
+                validated_questions.append(normalize_option_keys(mq))
+        return validated_questions
+    
+    def _parse_multi_mastery_questions(self, response, misses, count):
+        """Split a multi-concept mastery response back per concept; concepts it lacks get fallbacks"""
+        try:
+            with STAGE_SECONDS.time(stage="json_parse"):
+                sets = json_codec.loads(response)["concepts"]
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            logger.error(f"Batched mastery questions JSON error: {e}")
+            sets = []
+        
+        by_concept = {}
+        for entry in sets if isinstance(sets, list) else []:
+            try:
+                concept, _ = misses[int(entry["concept_index"]) - 1]
+            except (KeyError, TypeError, ValueError, IndexError):
+                continue
+            validated = self._validated_mastery_questions(entry.get("questions"))
+            if validated:
+                by_concept[concept] = validated
         
-        Generate {count} mastery questions that test the SAME CONCEPT from different angles.
+        for concept, _ in misses:
+            if concept not in by_concept:
+                logger.warning(f"No valid mastery questions for {concept} in batched response, using fallback")
+                by_concept[concept] = self._create_fallback_mastery_questions(concept, count)
         
+        logger.info(f"Successfully generated mastery questions for {len(misses)} concepts in one call")
+        return by_concept
+    
+    MASTERY_REQUIREMENTS = """
         CRITICAL REQUIREMENTS FOR MASTERY QUESTIONS:
         1. Test understanding, NOT memory or tricks
         2. Same core concept, different presentations and contexts
@@ -675,7 +3379,17 @@ class ProgressiveQuestionGenerator:
         4. Connect explanations back to the core concept being tested
         5. Help students understand the concept from multiple angles
         6. No lazy explanations - every explanation should teach something valuable
+        """
+    
+    def _create_mastery_prompt(self, failed_concept, original_question, count):
+        """Build the prompt for mastery questions on a missed concept"""
+        return f"""
+        The student got this question wrong: {original_question['question']}
+        Correct answer was: {original_question['correct_answer']}
+        Concept: {failed_concept}
         
+        Generate {count} mastery questions that test the SAME CONCEPT from different angles.
+        {self.MASTERY_REQUIREMENTS}
         IMPORTANT: Return ONLY JSON exactly like:
         {{
           "questions": [
@@ -699,43 +3413,49 @@ class ProgressiveQuestionGenerator:
         
         Remember: These are mastery questions for students who already got this concept wrong. Wrong answer explanations need to be exceptionally detailed and educational to help them truly understand.
         """
+    
+    def _create_multi_mastery_prompt(self, misses, count):
+        """Build one prompt covering every concept a student missed within the batching window"""
+        missed = "\n".join(
+            f"        {i}. Concept: {concept}\n"
+            f"           Question the student got wrong: {original_question['question']}\n"
+            f"           Correct answer was: {original_question['correct_answer']}"
+            for i, (concept, original_question) in enumerate(misses, 1)
+        )
+        return f"""
+        The student got these questions wrong:
+{missed}
         
-        try:
-            response = call_openai_api(
-                prompt, 
-                system_message=system_message,
-                temperature=0.3,
-                response_format={"type": "json_object"}
-            )
-            
-            parsed = json.loads(response)
-            mastery_questions = parsed["questions"]  # Extract questions array from object
-            
-            # Ensure it's a list
-            if not isinstance(mastery_questions, list):
-                mastery_questions = [mastery_questions] if mastery_questions else []
-            
-            # Validate and normalize each mastery question
-            validated_questions = []
-            for mq in mastery_questions:
-                if self._validate_question(mq):
-                    normalized_mq = normalize_option_keys(mq)
-                    shuffled_mq = shuffle_question_options(normalized_mq)
-                    validated_questions.append(shuffled_mq)
-            
-            if not validated_questions:
-                logger.warning("No valid mastery questions generated, using fallback")
-                return self._create_fallback_mastery_questions(failed_concept, count)
-            
-            logger.info(f"Successfully generated {len(validated_questions)} mastery questions")
-            return validated_questions
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"Mastery questions JSON error: {e}")
-            return self._create_fallback_mastery_questions(failed_concept, count)
-        except Exception as e:
-            logger.error(f"Mastery questions generation error: {e}")
-            return self._create_fallback_mastery_questions(failed_concept, count)
+        For EACH numbered concept, generate {count} mastery questions that test that SAME CONCEPT from different angles.
+        {self.MASTERY_REQUIREMENTS}
+        IMPORTANT: Return ONLY JSON exactly like:
+        {{
+          "concepts": [
+            {{
+              "concept_index": 1,
+              "questions": [
+                {{
+                    "mastery_question_id": 1,
+                    "original_concept": "Concept name from the list above",
+                    "question": "Different way to ask about the same concept - rephrased or different context",
+                    "options": {{"A": "...", "B": "...", "C": "...", "D": "..."}},
+                    "correct_answer": "C",
+                    "explanations": {{
+                        "correct": "Comprehensive explanation of why this is correct, reinforcing the core concept understanding",
+                        "A": "EXTREMELY DETAILED explanation of why A is wrong",
+                        "B": "EXTREMELY DETAILED explanation of why B is wrong",
+                        "C": "Reinforcing explanation of correct answer, connecting to core concept mastery",
+                        "D": "EXTREMELY DETAILED explanation of why D is wrong"
+                    }},
+                    "mastery_focus": "Understanding verification of the core concept"
+                }}
+              ]
+            }}
+          ]
+        }}
+        
+        Include one entry per numbered concept ({len(misses)} entries), each with exactly {count} questions.
+        """
     
     def _validate_question(self, question_data):
         """Validate question structure with improved checks"""
@@ -799,115 +3519,424 @@ class ProgressiveQuestionGenerator:
                 },
                 "mastery_focus": "Understanding verification"
             }
-            
-            # Normalize and shuffle
-            normalized_question = normalize_option_keys(question)
-            shuffled_question = shuffle_question_options(normalized_question)
-            questions.append(shuffled_question)
+            questions.append(question)
             
         return questions
 
-def _generate_batches_async(study_plan, start_index, qgen, queue):
-    """Background job: create batches 2-4 and append to queue in correct order"""
-    # Generate all remaining batches
-    batch_results = {}
+async def _build_batch(study_plan, batch_index, qgen):
+    """Generate one batch, falling back to template questions"""
+    batch = await qgen._generate_question_batch_async(
+        study_plan, qgen.batches[batch_index], start_id=batch_index*5+1,
+        system_message="You are an assessment engine. Output only valid JSON matching the schema the user provides, no prose."
+    )
+
+    if not batch:
+        batch = qgen._create_fallback_questions_batch(study_plan, batch_index*5+1, 5)
+
+    return batch
+
+# ------------------------------------------------------------------
+#  JUST-IN-TIME BATCHES: generate the next batch only as the student nears it
+# ------------------------------------------------------------------
+BATCH_COUNT = 4
+
+def lookahead_questions(answer_pace):
+    """Ready questions to keep ahead of the student: enough to cover one batch generation at their pace"""
+    pace = max(1.0, answer_pace or Config.LLM_SECONDS_PER_QUESTION)
+    return max(Config.BATCH_LOOKAHEAD_QUESTIONS, math.ceil(llm_latency.estimate("batch") / pace) + 1)
+
+def batches_outstanding(fields):
+    """Whether more main questions are still to come for a session"""
+    next_batch = fields['next_batch_index']
+    return next_batch is not None and (next_batch < BATCH_COUNT or bool(fields['batch_claimed_at']))
+
+def generation_outstanding(fields, now):
+    """Whether background generation still owes the session questions: batches or pending mastery questions"""
+    pending = fields['mastery_pending_at']
+    return batches_outstanding(fields) or bool(pending and now - pending < Config.BATCH_CLAIM_TIMEOUT_SECONDS)
+
+GENERATION_FIELDS = ['next_batch_index', 'batch_claimed_at', 'mastery_pending_at']
+
+def claim_next_batch(fields, now):
+    """Store changes claiming the next batch when the student is within the lookahead, else {}"""
+    next_batch = fields['next_batch_index']
+    if next_batch is None or next_batch >= BATCH_COUNT:
+        return {}
+    claimed_at = fields['batch_claimed_at']
+    if claimed_at and now - claimed_at < Config.BATCH_CLAIM_TIMEOUT_SECONDS:
+        return {}  # Already being generated
+    remaining = len(fields['main_questions']) - fields['current_index']
+    if remaining > lookahead_questions(fields['answer_pace']):
+        return {}
+    return {'batch_claimed_at': now}
+
+BATCH_CLAIM_FIELDS = ['main_questions', 'current_index', 'next_batch_index', 'batch_claimed_at', 'answer_pace']
+
+def ensure_next_batch(session_id):
+    """Start generating the session's next batch if the student is close enough to need it"""
+    claimed = {}
     
-    for i in range(start_index, 4):
-        batch = qgen._generate_question_batch(
-            study_plan, qgen.batches[i], start_id=i*5+1,
-            system_message="You are an assessment engine. Output only valid JSON matching the schema the user provides, no prose."
-        )
-        if not batch:
-            # Apply same normalization and shuffling to fallback questions
-            fallback_batch = qgen._create_fallback_questions_batch(study_plan, i*5+1, 5)
-            batch = [shuffle_question_options(normalize_option_keys(q)) for q in fallback_batch]
-        else:
-            # Apply normalization and shuffling to generated questions
-            batch = [shuffle_question_options(normalize_option_keys(q)) for q in batch]
-        
-        # Store batch with its index to maintain order
-        batch_results[i] = batch
+    def claim(fields):
+        changes = claim_next_batch(fields, time.time())
+        if changes:
+            claimed['batch_index'] = fields['next_batch_index']
+        return changes
+    
+    session_store.transaction(session_id, BATCH_CLAIM_FIELDS, claim)
+    if claimed:
+        session_work.submit(session_id, _generate_next_batch_async(session_id, claimed['batch_index']))
+
+async def _generate_next_batch_async(session_id, batch_index):
+    """Background job: generate one claimed batch, append it, then re-check the lookahead"""
+    fields = await asyncio.to_thread(
+        session_store.load, session_id, ['study_plan', 'main_questions', 'current_index', 'answer_pace']
+    )
+    if fields is None:
+        return  # Session expired or was removed
     
-    # Insert batches in correct order (Foundation→Core→Applications→Mastery)
-    for i in sorted(batch_results.keys()):
-        queue.main_questions.extend(batch_results[i])
+    # Task-local scope: due when the student is expected to run out of ready questions
+    llm_session_scope.set(session_id)
+    remaining = len(fields['main_questions']) - fields['current_index']
+    llm_priority.set(("near_term", time.time() + remaining * (fields['answer_pace'] or Config.LLM_SECONDS_PER_QUESTION)))
+    
+    batch = await _build_batch(fields['study_plan'], batch_index, ProgressiveQuestionGenerator())
+    stored = await asyncio.to_thread(
+        append_questions, session_id, batch, next_batch_index=batch_index + 1, batch_claimed_at=None
+    )
+    if stored:
+        # A fast student may already be within the lookahead of the new end of the queue
+        await asyncio.to_thread(ensure_next_batch, session_id)
 
 # ------------------------------------------------------------------
 #  BACKGROUND TASK: generate 5 mastery questions without blocking
 # ------------------------------------------------------------------
-def _async_generate_and_insert_mastery(session_id, concept_name, original_q):
+async def _async_generate_and_insert_mastery(session_id, misses, collected_at):
     """
-    Runs inside ThreadPoolExecutor.
-    Generates mastery questions for a failed concept and inserts them
-    into the existing QuestionQueue with smart spacing.
+    Runs on llm_loop.
+    Generates mastery questions for the concepts a student missed (one
+    call for the whole window) and inserts them into the existing
+    QuestionQueue with smart spacing, interleaving the concepts.
+    Clears mastery_pending_at unless a later wrong answer set it again
+    after the window closed at collected_at.
     """
-    session = sessions.get(session_id)
-    if not session or session.get("completed"):
+    session = await asyncio.to_thread(session_store.load, session_id, ["completed"])
+    if not session or session["completed"]:
         return  # Session no longer active
 
-    generator = session["question_generator"]
-    queue     = session["question_queue"]
+    llm_session_scope.set(session_id)  # Task-local
+    # Inserted a few slots ahead of the student, so this is speculative work with a deadline
+    llm_priority.set(("speculative", time.time() + 3 * Config.LLM_SECONDS_PER_QUESTION))
+    generator = ProgressiveQuestionGenerator()
+
+    def settle(fields):
+        pending = fields["mastery_pending_at"]
+        return {"mastery_pending_at": None} if pending and pending <= collected_at else {}
+
+    def insert(fields):
+        question_ids, changes = stage_questions(fields, mastery_qs)
+        queue = QuestionQueue.restore(fields["main_questions"], fields["current_index"])
+        queue.insert_mastery_questions(question_ids, spacing=3)
+        changes["main_questions"] = queue.main_questions
+        changes.update(settle(fields))
+        return changes
 
     try:
-        mastery_qs = generator.generate_mastery_questions(
-            concept_name,
-            original_q,
-            count=5
-        )
+        by_concept = await generator.generate_mastery_questions_for_misses_async(misses, count=5)
 
         # tag questions before inserting
-        for mq in mastery_qs:
-            mq["is_mastery_question"]    = True
-            mq["session_id"]             = session_id
-            mq["original_failed_concept"] = concept_name
+        for concept_name, questions in by_concept.items():
+            for mq in questions:
+                mq["is_mastery_question"]    = True
+                mq["session_id"]             = session_id
+                mq["original_failed_concept"] = concept_name
+
+        # Round-robin across concepts so one concept's questions are not bunched together
+        mastery_qs = [mq for group in itertools.zip_longest(*by_concept.values()) for mq in group if mq is not None]
 
-        queue.insert_mastery_questions(mastery_qs, spacing=3)
-        logger.info("Inserted %s mastery questions for session %s",
-                    len(mastery_qs), session_id)
+        stored = await asyncio.to_thread(
+            session_store.transaction, session_id,
+            ["main_questions", "current_index", "next_question_id", "mastery_pending_at"], insert
+        )
+        if stored is not None:
+            question_notifier.notify(session_id)
+        logger.info("Inserted %s mastery questions for %s concepts in session %s",
+                    len(mastery_qs), len(by_concept), session_id)
 
     except Exception as e:
         logger.error("Async mastery generation failed (%s): %s",
                      session_id, e)
+        # A student waiting at the end of the queue must not wait for questions that will never come
+        await asyncio.to_thread(session_store.transaction, session_id, ["mastery_pending_at"], settle)
+        question_notifier.notify(session_id)
+
+class MasteryCollector:
+    """Collects a session's wrong answers over a short window so they share one mastery call"""
+    
+    def __init__(self, window_seconds):
+        self.window_seconds = window_seconds
+        self._pending = {}  # session_id -> {concept: original question}; only touched on llm_loop
+        self.wrong_answers = 0
+        self.jobs = 0
+    
+    def add(self, session_id, concept_name, original_question):
+        """Record a wrong answer; safe to call from request threads"""
+        session_work.submit(session_id, self._collect(session_id, concept_name, original_question))
+    
+    async def _collect(self, session_id, concept_name, original_question):
+        self.wrong_answers += 1
+        pending = self._pending.get(session_id)
+        if pending is not None:
+            pending.setdefault(concept_name, original_question)  # A repeated concept needs one set
+            return
+        
+        # The first miss in a window waits for the rest, then generates for all of them
+        self._pending[session_id] = {concept_name: original_question}
+        try:
+            await asyncio.sleep(self.window_seconds)
+        finally:
+            misses = list(self._pending.pop(session_id).items())
+            collected_at = time.time()
+        self.jobs += 1
+        await _async_generate_and_insert_mastery(session_id, misses, collected_at)
+    
+    def get_stats(self):
+        return {"window_seconds": self.window_seconds, "wrong_answers": self.wrong_answers,
+                "jobs": self.jobs, "pending_sessions": len(self._pending)}
+
+mastery_collector = MasteryCollector(Config.MASTERY_BATCH_WINDOW_SECONDS)
+# ------------------------------------------------------------------
+
+# ------------------------------------------------------------------
+#  PREFETCH: keep study plans + Foundation batches warm for hot topics
+# ------------------------------------------------------------------
+class TopicPrefetcher:
+    """
+    Tracks topic popularity and keeps a small pool of ready study plans and
+    batch-0 questions for the top-N topics, refilled on llm_loop.
+    Pool entries are fresh generations (cache reads are skipped) so students
+    drawing from the pool do not all see the same question set.
+    """
+    
+    HALF_LIFE_SECONDS = 1800  # Popularity decay
+    
+    def __init__(self, top_n, pool_depth, max_age_seconds, refills_per_minute, token_budget_per_hour, tokens_per_entry,
+                 min_requests):
+        self.top_n = top_n
+        self.min_requests = min_requests
+        self.pool_depth = pool_depth
+        self.max_age_seconds = max_age_seconds
+        self.refill_interval = 60.0 / refills_per_minute if refills_per_minute > 0 else None
+        self.token_budget_per_hour = token_budget_per_hour
+        self.tokens_per_entry = tokens_per_entry
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self._popularity = OrderedDict()  # topic key -> [score, last_seen, topic, requests]
+        self._pools = {}                  # topic key -> list of (created_at, study_plan, batch0)
+        self._spend = []                  # (timestamp, estimated tokens) within the last hour
+        self._lock = threading.Lock()
+        self._refill_started = False
+    
+    @staticmethod
+    def topic_key(topic):
+        return content_cache_identity(topic, "topic")[1]
+    
+    def record_request(self, topic):
+        """Bump a topic's popularity and make sure the refill loop is running"""
+        key = self.topic_key(topic)
+        now = time.time()
+        with self._lock:
+            score, last_seen, _, requests = self._popularity.pop(key, (0.0, now, topic, 0))
+            self._popularity[key] = [self._decay(score, now - last_seen) + 1, now, topic, requests + 1]
+            # Bound tracking memory to a multiple of the warm set
+            while len(self._popularity) > self.top_n * 10:
+                stale_key, _ = self._popularity.popitem(last=False)
+                self._pools.pop(stale_key, None)
+            start_refill = not self._refill_started and self.refill_interval is not None
+            self._refill_started = True
+        if start_refill:
+            llm_loop.submit(self._refill_loop())
+    
+    def take(self, topic):
+        """Pop a ready (study_plan, batch0) pair for a topic, or None"""
+        key = self.topic_key(topic)
+        cutoff = time.time() - self.max_age_seconds
+        with self._lock:
+            pool = [entry for entry in self._pools.get(key, []) if entry[0] >= cutoff]
+            if not pool:
+                self._pools.pop(key, None)
+                self.misses += 1
+                return None
+            _, study_plan, batch0 = pool.pop(0)
+            self._pools[key] = pool
+            self.hits += 1
+            return study_plan, batch0
+    
+    def _decay(self, score, elapsed):
+        return score * math.pow(0.5, elapsed / self.HALF_LIFE_SECONDS)
+    
+    def _hot_topics(self):
+        """Top-N topics by decayed popularity; one-off topics never qualify"""
+        now = time.time()
+        ranked = sorted(
+            ((self._decay(score, now - last_seen), key, topic)
+             for key, (score, last_seen, topic, requests) in self._popularity.items()
+             if requests >= self.min_requests),
+            reverse=True
+        )
+        return [(key, topic) for _, key, topic in ranked[:self.top_n]]
+    
+    def _next_refill(self):
+        """Pick the hot topic with the emptiest pool, honoring the hourly token budget"""
+        if llm_breaker.state != "closed":
+            return None  # Speculative work waits until the provider is healthy again
+        now = time.time()
+        with self._lock:
+            self._spend = [(t, tokens) for t, tokens in self._spend if t > now - 3600]
+            if sum(tokens for _, tokens in self._spend) + self.tokens_per_entry > self.token_budget_per_hour:
+                return None
+            
+            hot = self._hot_topics()
+            hot_keys = {key for key, _ in hot}
+            for key in list(self._pools):
+                if key not in hot_keys:
+                    del self._pools[key]
+            
+            candidates = [(len(self._pools.get(key, [])), key, topic) for key, topic in hot]
+            candidates = [c for c in candidates if c[0] < self.pool_depth]
+            if not candidates:
+                return None
+            
+            _, key, topic = min(candidates, key=lambda c: c[0])
+            self._spend.append((now, self.tokens_per_entry))
+            return key, topic
+    
+    async def _refill_loop(self):
+        llm_priority.set(("speculative", None))  # Task-local; prefetch never delays a waiting user
+        while True:
+            await asyncio.sleep(self.refill_interval)
+            target = self._next_refill()
+            if target is None:
+                continue
+            key, topic = target
+            try:
+                entry = await self._generate_entry(topic)
+            except Exception as e:
+                logger.error(f"Prefetch failed for topic {topic[:50]}: {e}")
+                continue
+            if entry is None:
+                continue
+            with self._lock:
+                if key in self._popularity:
+                    self._pools.setdefault(key, []).append(entry)
+                    self.refills += 1
+    
+    async def _generate_entry(self, topic):
+        planner = StudyPlanGenerator()
+        study_plan = await planner.create_study_plan_async(topic, "topic", use_cache=False)
+        if planner.is_fallback_plan(study_plan):
+            return None  # Never pool fallback plans either
+        qgen = ProgressiveQuestionGenerator()
+        batch0 = await qgen._generate_question_batch_async(
+            study_plan, qgen.batches[0], start_id=1,
+            system_message="You are an assessment engine. Output only valid JSON matching the schema the user provides, no prose.",
+            use_cache=False
+        )
+        if not batch0:
+            return None  # Never pool fallback questions
+        return (time.time(), study_plan, batch0)
+    
+    def get_stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                "topics_tracked": len(self._popularity),
+                "pooled_entries": sum(len(pool) for pool in self._pools.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "refills": self.refills,
+                "estimated_tokens_last_hour": sum(tokens for t, tokens in self._spend if t > now - 3600)
+            }
+
+prefetcher = TopicPrefetcher(
+    Config.PREFETCH_TOP_N,
+    Config.PREFETCH_POOL_DEPTH,
+    Config.PREFETCH_MAX_AGE_SECONDS,
+    Config.PREFETCH_REFILLS_PER_MINUTE,
+    Config.PREFETCH_TOKEN_BUDGET_PER_HOUR,
+    Config.PREFETCH_TOKENS_PER_ENTRY,
+    Config.PREFETCH_MIN_REQUESTS
+) if Config.PREFETCH_ENABLED else None
 # ------------------------------------------------------------------
 
 class QuestionQueue:
-    """Manages the progressive question queue with smart mastery insertion"""
+    """
+    Manages the progressive question queue with smart mastery insertion.
+    main_questions is an immutable tuple of question ids (bodies are kept in
+    the session store) that is only ever replaced, never mutated, so any
+    reader holding a reference has a consistent snapshot and background
+    writers cannot corrupt the order under a concurrent reader.
+    """
     
     def __init__(self, pre_generated_questions):
-        self.main_questions = pre_generated_questions.copy()
+        self.main_questions = tuple(pre_generated_questions)
         self.current_index = 0
-        self.completed_questions = []
+    
+    @classmethod
+    def restore(cls, main_questions, current_index):
+        """Rebuild a queue from the fields kept in the session store"""
+        queue = cls.__new__(cls)
+        queue.main_questions = tuple(main_questions)  # No copy when already a tuple
+        queue.current_index = current_index
+        return queue
+    
+    @staticmethod
+    def appended(main_questions, questions):
+        """New snapshot with questions added at the end"""
+        return tuple(main_questions) + tuple(questions)
+    
+    @property
+    def completed_questions(self):
+        # Mastery questions are only inserted ahead of current_index, so the prefix is stable
+        return self.main_questions[:self.current_index]
         
     def insert_mastery_questions(self, mastery_questions, spacing=3):
-        """Smart insertion of mastery questions with spacing"""
+        """Smart insertion of mastery questions with spacing, in a single merge pass"""
         if not mastery_questions:
             return
         
+        total = len(self.main_questions)
+        count = len(mastery_questions)
+        
         # Calculate insertion points with spacing
-        remaining_slots = len(self.main_questions) - self.current_index - 1
+        remaining_slots = total - self.current_index - 1
         
         if remaining_slots <= 0:
             # Add to end if no remaining main questions
-            self.main_questions.extend(mastery_questions)
+            self.main_questions = self.appended(self.main_questions, mastery_questions)
             return
         
-        # Calculate optimal spacing
-        if len(mastery_questions) == 1:
-            insert_point = min(self.current_index + spacing, len(self.main_questions))
-            self.main_questions.insert(insert_point, mastery_questions[0])
-        else:
-            # Distribute multiple mastery questions
-            spacing_interval = max(2, remaining_slots // len(mastery_questions))
-            
-            for i, mastery_q in enumerate(mastery_questions):
-                insert_point = min(
-                    self.current_index + spacing + (i * spacing_interval),
-                    len(self.main_questions)
-                )
-                self.main_questions.insert(insert_point, mastery_q)
+        # Distribute mastery questions; each point is where that question ends up in
+        # the final order (clamped to the end, which grows by one per insertion)
+        spacing_interval = max(2, remaining_slots // count)
+        positions = [
+            min(self.current_index + spacing + i * spacing_interval, total + i)
+            for i in range(count)
+        ]
+        
+        merged = []
+        main_iter = iter(self.main_questions)
+        next_mastery = 0
+        for position in range(total + count):
+            if next_mastery < count and positions[next_mastery] == position:
+                merged.append(mastery_questions[next_mastery])
+                next_mastery += 1
+            else:
+                merged.append(next(main_iter))
+        self.main_questions = tuple(merged)
     
     def get_next_question(self):
-        """Get the next question in the queue"""
+        """Get the id of the next question in the queue"""
         if self.current_index >= len(self.main_questions):
             return None
         
@@ -917,14 +3946,12 @@ class QuestionQueue:
     def advance_queue(self):
         """Move to the next question"""
         if self.current_index < len(self.main_questions):
-            self.completed_questions.append(self.main_questions[self.current_index])
             self.current_index += 1
     
-    def get_progress(self):
-        """Get current progress statistics"""
+    def get_progress(self, loading=False):
+        """Get current progress statistics; loading means background generation still owes questions"""
         total = len(self.main_questions)
         current = self.current_index
-        loading = len(self.main_questions) < 20  # Add loading flag
         return {
             "current_question": current + 1,
             "total_questions": total,
@@ -934,90 +3961,336 @@ class QuestionQueue:
             "loading": loading
         }
 
+@timed_stage("session_create")
 def create_progressive_session(topic_or_content, session_type="topic"):
     """Create a new progressive learning session with pre-generated questions"""
     session_id = str(uuid.uuid4())
     
-    # Clean up expired sessions periodically
-    cleanup_expired_sessions()
+    qgen = ProgressiveQuestionGenerator()
     
-    # Generate study plan
-    study_plan_generator = StudyPlanGenerator()
-    study_plan = study_plan_generator.create_study_plan(topic_or_content, session_type)
+    # Popular topics may already have a study plan and batch 0 waiting in the pool
+    warm_entry = None
+    if prefetcher and session_type == "topic":
+        prefetcher.record_request(topic_or_content)
+        warm_entry = prefetcher.take(topic_or_content)
     
-    # ---------- batch-0 sync ----------
-    qgen = ProgressiveQuestionGenerator()
-
-    batch0 = qgen._generate_question_batch(
-        study_plan, qgen.batches[0], start_id=1,
-        system_message="You are an assessment engine. Output only valid JSON matching the schema the user provides, no prose."
-    )
+    if warm_entry:
+        study_plan, batch0 = warm_entry
+    else:
+        with charging_session(session_id):
+            # Generate study plan
+            study_plan_generator = StudyPlanGenerator()
+            study_plan = study_plan_generator.create_study_plan(topic_or_content, session_type)
+            
+            # ---------- batch-0 sync ----------
+            batch0 = qgen._generate_question_batch(
+                study_plan, qgen.batches[0], start_id=1,
+                system_message="You are an assessment engine. Output only valid JSON matching the schema the user provides, no prose."
+            )
 
     # ───── simple diagnostics ───────────────────────────────────────────
-    print("DEBUG - batch0 returned:", 0 if batch0 is None else len(batch0))
+    logger.debug("batch0 returned: %s", 0 if batch0 is None else len(batch0))
     # --------------------------------------------------------------------
 
     if not batch0 or len(batch0) == 0:          # [] or None  → fallback
-        print("DEBUG - using fallback batch0")
+        logger.debug("using fallback batch0")
         batch0 = qgen._create_fallback_questions_batch(study_plan, 1, 5)
 
     if not batch0 or len(batch0) == 0:          # still empty → hard error
         raise APIError("No questions generated for batch-0", 500)
 
-    print("DEBUG - batch0 after fallback:", len(batch0))
+    logger.debug("batch0 after fallback: %s", len(batch0))
 
-    questions = [shuffle_question_options(normalize_option_keys(q)) for q in batch0]
-    print("DEBUG - questions entering queue:", len(questions))
+    logger.debug("questions entering queue: %s", len(batch0))
+
+    # Initialize session with first batch ready
+    _register_session(session_id, session_type, topic_or_content, study_plan, batch0)
 
-    queue = QuestionQueue(questions)
+    # ---------- batches 1-3 just in time ----------
+    ensure_next_batch(session_id)
+    
+    logger.info(f"Created new session with first batch ready: {session_id}")
+    return session_id
 
+def stage_questions(fields, questions):
+    """Assign compact per-session ids and a random option order; returns (ids, store changes) for a session transaction"""
+    next_id = fields['next_question_id']
+    question_ids = []
+    changes = {}
+    for question in questions:
+        # Shallow copy: the option texts and explanations are shared, only the order is per session
+        question = dict(question, question_id=next_id, option_order=shuffled_option_order())
+        question_ids.append(next_id)
+        changes[question_field(next_id)] = question
+        next_id += 1
+    changes['next_question_id'] = next_id
+    return question_ids, changes
 
-    # ---------- batches 1-3 async ----------
-    executor.submit(_generate_batches_async, study_plan, 1, qgen, queue)
+class QuestionNotifier:
+    """Wakes requests waiting for a session's next question as soon as questions are added"""
     
-    # Initialize session with first batch ready
-    sessions[session_id] = {
+    def __init__(self, recheck_seconds):
+        self.recheck_seconds = recheck_seconds
+        self._lock = threading.Lock()
+        self._waiting = {}  # session_id -> [condition, version, waiter count]
+        self.notifications = 0
+        self.wakeups = 0
+        self.timeouts = 0
+    
+    def notify(self, session_id):
+        """Questions were added to the session (or it can no longer get any)"""
+        with self._lock:
+            self.notifications += 1
+            entry = self._waiting.get(session_id)
+        if entry is not None:
+            with entry[0]:
+                entry[1] += 1
+                entry[0].notify_all()
+    
+    def wait(self, session_id, check, timeout):
+        """
+        Call check() until it returns something other than None, sleeping
+        between calls until notified. Wakes every recheck_seconds too, for
+        questions added by another worker process. Returns None on timeout.
+        """
+        deadline = time.time() + timeout
+        with self._lock:
+            entry = self._waiting.setdefault(session_id, [threading.Condition(), 0, 0])
+            entry[2] += 1
+        try:
+            while True:
+                version = entry[1]  # Read before checking so a notify during check() is not missed
+                result = check()
+                if result is not None:
+                    self.wakeups += 1
+                    return result
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    return None
+                with entry[0]:
+                    if entry[1] == version:
+                        entry[0].wait(min(remaining, self.recheck_seconds))
+        finally:
+            with self._lock:
+                entry[2] -= 1
+                if not entry[2]:
+                    del self._waiting[session_id]
+    
+    def get_stats(self):
+        with self._lock:
+            return {"waiting_sessions": len(self._waiting), "notifications": self.notifications,
+                    "wakeups": self.wakeups, "timeouts": self.timeouts}
+
+question_notifier = QuestionNotifier(Config.NEXT_QUESTION_RECHECK_SECONDS)
+
+def append_questions(session_id, questions, **extra_changes):
+    """Store questions server-side and add their ids to the end of the queue (with any extra field changes)"""
+    staged = []
+    
+    def append(fields):
+        question_ids, changes = stage_questions(fields, questions)
+        changes.update(extra_changes)
+        changes['main_questions'] = QuestionQueue.appended(fields['main_questions'], question_ids)
+        staged[:] = [changes[question_field(question_id)] for question_id in question_ids]
+        return changes
+    
+    if session_store.transaction(session_id, ['main_questions', 'next_question_id'], append) is None:
+        return []  # Session expired or was removed
+    question_notifier.notify(session_id)
+    return staged
+
+def _register_session(session_id, session_type, topic_or_content, study_plan, questions, batch_claimed_at=None):
+    """Store the state for a new session; batch_claimed_at holds back batch 1 while batch 0 is still streaming"""
+    # Expired sessions are reaped in the background rather than scanned here
+    session_reaper.start()
+    now = time.time()
+    question_ids, question_fields = stage_questions({'next_question_id': 1}, questions)
+    session_store.create(session_id, {
+        **question_fields,
         'id': session_id,
         'type': session_type,
         'content': topic_or_content,
         'study_plan': study_plan,
-        'question_queue': queue,
-        'question_generator': qgen,
+        'main_questions': tuple(question_ids),
+        'current_index': 0,
         'current_concept_index': 0,
         'score': 100,
         'correct_answers': 0,
         'incorrect_answers': 0,
         'completed': False,
         'learned_concepts': [],
-        'created_at': datetime.now()
-    }
+        'created_at': datetime.now().isoformat(),
+        'last_activity': now,
+        'token_usage': token_ledger.take_pending(session_id),
+        'next_batch_index': 1,     # Batch 0 is stored above; the rest are generated just in time
+        'batch_claimed_at': batch_claimed_at,
+        'answer_pace': None,       # Smoothed seconds per answer
+        'mastery_pending_at': None # Latest wrong answer whose mastery questions are not inserted yet
+    })
+    touch_session(session_id, now)
+
+def stream_progressive_session(topic_or_content, session_type="topic"):
+    """
+    Create a session while streaming it: yields ("study_plan", plan), then
+    ("question", q) for each batch-0 question as soon as it is parsed, then
+    ("done", progress). The session is registered when the first question
+    is ready, so the student can answer it while the rest are generated.
+    """
+    session_id = str(uuid.uuid4())
     
-    logger.info(f"Created new session with first batch ready: {session_id}")
-    return session_id
+    qgen = ProgressiveQuestionGenerator()
+    system_message = "You are an assessment engine. Output only valid JSON matching the schema the user provides, no prose."
+    
+    warm_entry = None
+    if prefetcher and session_type == "topic":
+        prefetcher.record_request(topic_or_content)
+        warm_entry = prefetcher.take(topic_or_content)
+    
+    if warm_entry:
+        study_plan, batch0 = warm_entry
+        question_source = iter(batch0)
+    else:
+        with charging_session(session_id):
+            study_plan = StudyPlanGenerator().create_study_plan(topic_or_content, session_type)
+        question_source = charged_iter(session_id, qgen.stream_question_batch(study_plan, qgen.batches[0], 1, system_message))
+    
+    yield "study_plan", {"session_id": session_id, "study_plan": study_plan}
+    
+    registered = False
+    streamed_count = 0
+    # Batch 0 keeps the batch claim until it is complete, so an early answer
+    # cannot append batch 1 (Core) ahead of the rest of the Foundation questions
+    stream_claim = time.time()
+    try:
+        try:
+            for question in question_source:
+                streamed_count += 1
+                if not registered:
+                    _register_session(session_id, session_type, topic_or_content, study_plan, [question],
+                                      batch_claimed_at=stream_claim)
+                    registered = True
+                    yield "question", get_next_progressive_question(session_id)
+                else:
+                    stored = append_questions(session_id, [question])
+                    if stored:
+                        raw = question_json(session_id, stored[0]['question_id'], stored[0])
+                        yield "question", JSONFragment(raw, {'question_number': streamed_count})
+        except APIError as e:
+            logger.error(f"Streaming batch-0 failed for session {session_id}: {e.message}")
+        
+        if registered and streamed_count < 5:
+            # The stream broke off or dropped invalid questions: fill the rest of batch 0
+            # with fallback questions now rather than leave the session short
+            missing = qgen._create_fallback_questions_batch(study_plan, streamed_count + 1, 5 - streamed_count)
+            for number, question in enumerate(append_questions(session_id, missing), start=streamed_count + 1):
+                raw = question_json(session_id, question['question_id'], question)
+                yield "question", JSONFragment(raw, {'question_number': number})
+        
+        if not registered:
+            # Nothing usable was streamed: fall back exactly like the blocking path
+            fallback = qgen._create_fallback_questions_batch(study_plan, 1, 5)
+            _register_session(session_id, session_type, topic_or_content, study_plan, fallback)
+            registered = True
+            yield "question", get_next_progressive_question(session_id)
+            for number in range(2, len(fallback) + 1):
+                yield "question", JSONFragment(question_json(session_id, number), {'question_number': number})
+        
+        _release_stream_claim(session_id, stream_claim)
+        fields = load_session(session_id, ['main_questions', 'current_index'] + GENERATION_FIELDS)
+        progress = QuestionQueue.restore(fields['main_questions'], fields['current_index']).get_progress(
+            generation_outstanding(fields, time.time()))
+        yield "done", {"session_id": session_id, "progress": progress}
+    finally:
+        # Runs even if the client disconnects mid-stream; batches 1-3 append after batch 0
+        if registered:
+            _release_stream_claim(session_id, stream_claim)
+            ensure_next_batch(session_id)
+            logger.info(f"Created new streamed session: {session_id}")
+
+def _release_stream_claim(session_id, stream_claim):
+    """Batch 0 is complete: drop its claim unless it already expired and batch 1 was claimed since"""
+    def release(fields):
+        return {'batch_claimed_at': None} if fields['batch_claimed_at'] == stream_claim else {}
+    
+    session_store.transaction(session_id, ['batch_claimed_at'], release)
 
 def get_next_progressive_question(session_id):
     """Get the next pre-generated question (instant response)"""
-    if session_id not in sessions:
-        raise APIError("Session not found", 404)
+    session = load_session(session_id, ['main_questions', 'current_index', 'score'] + GENERATION_FIELDS)
+    queue = QuestionQueue.restore(session['main_questions'], session['current_index'])
+    
+    next_question = build_question_payload(session_id, queue, session['score'],
+                                           loading=generation_outstanding(session, time.time()))
+    if not next_question:
+        if not generation_outstanding(session, time.time()):
+            # All questions completed
+            session_store.save(session_id, {'completed': True})
+        return None
+    
+    return next_question
+
+def wait_for_next_question(session_id, current_index, timeout=None):
+    """
+    Wait until questions past current_index exist or generation owes the
+    session nothing more. Returns the session fields (with 'queue'), or None
+    on timeout.
+    """
+    def check():
+        fields = session_store.load(session_id, ['main_questions', 'current_index', 'score'] + GENERATION_FIELDS)
+        if fields is None:
+            raise APIError("Session not found", 404)
+        if len(fields['main_questions']) > current_index or not generation_outstanding(fields, time.time()):
+            fields['queue'] = QuestionQueue.restore(fields['main_questions'], fields['current_index'])
+            return fields
+        return None
+    
+    return question_notifier.wait(session_id, check, timeout or Config.NEXT_QUESTION_LONG_POLL_SECONDS)
+
+def client_question(question, **metadata):
+    """Copy of a stored question in display order, without the answer key, which never leaves the server"""
+    payload = {key: value for key, value in question.items() if key not in ('correct_answer', 'explanations', 'option_order')}
+    payload['options'] = displayed_options(question)
+    payload.update(metadata)
+    return payload
+
+def question_json(session_id, question_id, question=None):
+    """Serialized client view of a staged question, or None if it does not exist"""
+    raw = question_json_cache.get(session_id, question_id)
+    if raw is not None:
+        return raw
     
-    session = sessions[session_id]
-    queue = session['question_queue']
+    if question is None:
+        stored = session_store.load(session_id, [question_field(question_id)])
+        question = stored and stored[question_field(question_id)]
+        if not question:
+            return None
     
+    payload = client_question(question)
+    payload.pop('session_id', None)  # Per-response metadata, added by the caller
+    payload['is_mastery_question'] = payload.get('mastery_question_id') is not None
+    raw = json_codec.dumps(payload)
+    question_json_cache.put(session_id, question_id, raw)
+    return raw
+
+def build_question_payload(session_id, queue, score, loading=False):
+    """The next question in the queue plus the metadata the client renders"""
     # Get next pre-generated question (no OpenAI call needed)
-    next_question = queue.get_next_question()
-    if not next_question:
-        # All questions completed
-        session['completed'] = True
+    question_id = queue.get_next_question()
+    if question_id is None:
         return None
     
-    # Add metadata
-    next_question['session_id'] = session_id
-    next_question['question_number'] = queue.current_index + 1
-    next_question['is_mastery_question'] = next_question.get('mastery_question_id') is not None
-    next_question['progress'] = queue.get_progress()
-    next_question['score'] = session['score']
+    # The question itself is serialized once; only the metadata is encoded per response
+    raw = question_json(session_id, question_id)
+    if raw is None:
+        return None
     
-    return next_question
+    return JSONFragment(raw, {
+        'session_id': session_id,
+        'question_number': queue.current_index + 1,
+        'progress': queue.get_progress(loading),
+        'score': score,
+    })
 
 # Error handlers
 @app.errorhandler(ValidationError)
@@ -1052,10 +4325,46 @@ def health_check():
         "message": "ALP3 Progressive Learning API is running",
         "version": "4.1",
         "model": Config.OPENAI_MODEL,
-        "active_sessions": len(sessions),
+        "active_sessions": session_store.count(),
+        "session_store": Config.SESSION_STORE,
+        "session_reaper": session_reaper.get_stats(),
+        "rate_limiter": rate_limiter.get_stats(),
+        "question_json": question_json_cache.get_stats(),
+        "pdf_extraction": pdf_stats.get_stats(),
+        "http_pool": llm_http.get_stats(),
+        "async_llm": llm_loop.get_stats(),
+        "generation_cache": generation_cache.get_stats(),
+        "single_flight": single_flight.get_stats(),
+        "token_usage": token_ledger.get_stats(),
+        "circuit_breaker": llm_breaker.get_stats(),
+        "llm_scheduler": llm_scheduler.get_stats(),
+        "llm_latency": llm_latency.get_stats(),
+        "mastery_batching": mastery_collector.get_stats(),
+        "session_work": session_work.get_stats(),
+        "question_notifier": question_notifier.get_stats(),
+        "prefetch": prefetcher.get_stats() if prefetcher else None,
         "environment": "development" if Config.DEBUG else "production"
     })
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text exposition of this worker's metrics"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # The URL rule, not the path, keeps label cardinality bounded
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, route=route,
+                                     method=request.method, status=str(response.status_code))
+    return response
+
 @app.route('/<path:filename>', methods=['GET'])
 def static_files(filename):
     return send_from_directory(app.static_folder, filename)
@@ -1064,7 +4373,7 @@ def static_files(filename):
 def start_progressive_session():
     try:
         # Check rate limiting
-        client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.environ.get('REMOTE_ADDR', 'unknown'))
+        client_ip = client_address()
         if not check_rate_limit(client_ip):
             raise APIError('Rate limit exceeded. Please wait before creating another session.', 429)
         
@@ -1104,7 +4413,7 @@ def start_progressive_session():
             
             # Extract text from PDF
             file_content = file.read()
-            extracted_text = extract_pdf_text(file_content)
+            extracted_text = extract_pdf_text(file_content, max_chars=Config.PDF_MAX_DOCUMENT_CHARS)
             
             if not extracted_text.strip():
                 raise APIError('Could not extract text from PDF file')
@@ -1131,6 +4440,35 @@ def start_progressive_session():
     except Exception as e:
         logger.error(f"Start progressive session error: {e}")
         raise APIError(f'Failed to start session: {str(e)}', 500)
+@app.route('/api/stream-progressive-session', methods=['POST'])
+def stream_progressive_session_route():
+    """Server-Sent Events variant of start-progressive-session (topic sessions)"""
+    client_ip = client_address()
+    if not check_rate_limit(client_ip):
+        raise APIError('Rate limit exceeded. Please wait before creating another session.', 429)
+    
+    data = request.get_json()
+    validate_session_data(data)
+    if data.get('type') != 'topic':
+        raise ValidationError('Streaming sessions support topic sessions only')
+    
+    topic = sanitize_input(data.get('topic'))
+    logger.info(f"Streaming progressive session for topic: {topic} (IP: {client_ip})")
+    
+    def event_stream():
+        try:
+            for event, payload in stream_progressive_session(topic, 'topic'):
+                yield f"event: {event}\ndata: {json_codec.dumps(payload).decode('utf-8')}\n\n"
+        except Exception as e:
+            logger.error(f"Stream progressive session error: {e}")
+            yield f"event: error\ndata: {json_codec.dumps({'error': 'Failed to start session'}).decode('utf-8')}\n\n"
+    
+    return Response(
+        stream_with_context(event_stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/submit-progressive-answer', methods=['POST'])
 def submit_progressive_answer():
     try:
@@ -1141,96 +4479,147 @@ def submit_progressive_answer():
 
         session_id       = data.get("session_id")
         selected_answer  = data.get("selected_answer", "").upper()
-        current_question = data.get("current_question")
+        question_id      = data.get("question_id")
 
-        if session_id not in sessions:
-            raise APIError("Session not found", 404)
+        if not check_rate_limit(client_address(), "answer"):
+            raise APIError("Rate limit exceeded. Please slow down.", 429)
 
-        session   = sessions[session_id]
-        queue     = session["question_queue"]
-        generator = session["question_generator"]   # still needed later
+        def apply_answer(session):
+            """Score the answer and advance the queue; returns only the fields that change"""
+            # The store may retry this on a conflict; only the committed attempt may report a claim or error
+            result.clear()
+            queue = QuestionQueue.restore(session["main_questions"], session["current_index"])
 
-        correct_answer = current_question.get("correct_answer", "").upper()
-        is_correct     = selected_answer == correct_answer
+            # Only the question currently being shown can be answered, and the answer
+            # key comes from the server-side copy, never from the client
+            current_question = session[question_field(question_id)]
+            if current_question is None or queue.get_next_question() != question_id:
+                result["error"] = "Question is not the current question for this session"
+                return {}
 
-        # ────────────────────────────────────────────────────────────
-        # 2 — update score / schedule mastery questions (non-blocking)
-        # ────────────────────────────────────────────────────────────
-        if is_correct:
-            session["correct_answers"] += 1
-            session["score"]           += 10
-
-            # mark concept learned (only for main questions)
-            if not current_question.get("is_mastery_question", False):
-                cid = current_question.get("concept_id")
-                if cid and cid not in session["learned_concepts"]:
-                    session["learned_concepts"].append(cid)
-                    session["current_concept_index"] += 1
-        else:
-            session["incorrect_answers"] += 1
-            session["score"]              = max(0, session["score"] - 5)
-
-            # fire-and-forget mastery generation
-            if not current_question.get("is_mastery_question", False):
-                concept_name = current_question.get("teaching_focus", "Unknown concept")
-                executor.submit(
-                    _async_generate_and_insert_mastery,
-                    session_id,
-                    concept_name,
-                    current_question
-                )
+            # Answers arrive as displayed letters; scoring and explanations use the stored keys
+            correct_answer = current_question.get("correct_answer", "").upper()
+            is_correct     = canonical_option(current_question, selected_answer) == correct_answer
+            result.update(current_question=current_question, correct_answer=correct_answer, is_correct=is_correct)
 
-        # ────────────────────────────────────────────────────────────
-        # 3 — advance queue and build explanation text
-        # ────────────────────────────────────────────────────────────
-        queue.advance_queue()
+            learned_concepts = list(session["learned_concepts"])
+            changes = {"learned_concepts": learned_concepts}
+
+            # ────────────────────────────────────────────────────────────
+            # 2 — update score
+            # ────────────────────────────────────────────────────────────
+            if is_correct:
+                changes["correct_answers"] = session["correct_answers"] + 1
+                changes["score"]           = session["score"] + 10
+
+                # mark concept learned (only for main questions)
+                changes["current_concept_index"] = session["current_concept_index"]
+                if not current_question.get("is_mastery_question", False):
+                    cid = current_question.get("concept_id")
+                    if cid and cid not in learned_concepts:
+                        learned_concepts.append(cid)
+                        changes["current_concept_index"] += 1
+            else:
+                changes["incorrect_answers"] = session["incorrect_answers"] + 1
+                changes["score"]             = max(0, session["score"] - 5)
+
+                # mastery questions for this miss are on their way (see mastery_collector)
+                if not current_question.get("is_mastery_question", False):
+                    changes["mastery_pending_at"] = now
+
+            # ────────────────────────────────────────────────────────────
+            # 3 — advance queue
+            # ────────────────────────────────────────────────────────────
+            queue.advance_queue()
+            changes["current_index"] = queue.current_index
+            changes["last_activity"] = now
+
+            # Smoothed answer pace drives how far ahead the next batch is generated
+            interval = min(now - (session["last_activity"] or now), 300)
+            pace = session["answer_pace"]
+            changes["answer_pace"] = interval if pace is None else 0.7 * pace + 0.3 * interval
+            changes.update(claim_next_batch({**session, **changes}, now))
+            if changes.get("batch_claimed_at"):
+                result["claimed_batch"] = session["next_batch_index"]
+
+            # Running ahead of just-in-time generation is not the end of the session
+            result["loading"] = generation_outstanding({**session, **changes}, now)
+            changes["completed"] = queue.current_index >= len(queue.main_questions) and not result["loading"]
+
+            result.update(
+                queue=queue,
+                correct_answers=changes.get("correct_answers", session["correct_answers"]),
+                incorrect_answers=changes.get("incorrect_answers", session["incorrect_answers"]),
+            )
+            return changes
+
+        result = {}
+        now = time.time()
+        changes = session_store.transaction(
+            session_id,
+            ["main_questions", "current_index", "score", "correct_answers", "incorrect_answers",
+             "learned_concepts", "current_concept_index", "last_activity", "next_batch_index",
+             "batch_claimed_at", "answer_pace", "mastery_pending_at", question_field(question_id)],
+            apply_answer
+        )
+        if changes is None:
+            raise APIError("Session not found", 404)
+        if "error" in result:
+            raise APIError(result["error"], 409)
+        touch_session(session_id, now)
+
+        current_question = result["current_question"]
+        correct_answer   = result["correct_answer"]
+        is_correct       = result["is_correct"]
+        queue            = result["queue"]
+        score            = changes["score"]
+        learned_concepts = changes["learned_concepts"]
+
+        if "claimed_batch" in result:
+            session_work.submit(session_id, _generate_next_batch_async(session_id, result["claimed_batch"]))
 
+        # fire-and-forget mastery generation (non-blocking), batched per session
+        if not is_correct and not current_question.get("is_mastery_question", False) and not changes["completed"]:
+            concept_name = current_question.get("teaching_focus", "Unknown concept")
+            mastery_collector.add(session_id, concept_name, current_question)
+
+        # build explanation text
         explanations = current_question.get("explanations", {})
         if is_correct:
             explanation_text = explanations.get("correct", "Correct!")
         else:
-            wrong_expl       = explanations.get(selected_answer, "This answer is incorrect.")
+            wrong_expl       = explanations.get(canonical_option(current_question, selected_answer), "This answer is incorrect.")
             correct_expl     = explanations.get("correct", "No explanation available.")
             explanation_text = (
                 f"❌ Your answer ({selected_answer}): {wrong_expl}\n\n"
-                f"✅ Correct answer ({correct_answer}): {correct_expl}"
+                f"✅ Correct answer ({displayed_option(current_question, correct_answer)}): {correct_expl}"
             )
 
         # ────────────────────────────────────────────────────────────
-        # 4 — session complete?  otherwise return next pre-generated Q
+        # 4 — session complete?  otherwise return next pre-generated Q
         # ────────────────────────────────────────────────────────────
-        progress = queue.get_progress()
-        if queue.current_index >= len(queue.main_questions):
-            session["completed"] = True
+        progress = queue.get_progress(result["loading"])
+        if changes["completed"]:
             logger.info("Session completed: %s", session_id)
+            session_work.cancel(session_id)  # e.g. mastery questions nobody will see
             return jsonify({
                 "session_complete": True,
-                "final_score":       session["score"],
+                "final_score":       score,
                 "total_questions":   len(queue.completed_questions),
-                "learned_concepts":  len(session["learned_concepts"]),
+                "learned_concepts":  len(learned_concepts),
                 "summary": {
-                    "correct_answers":   session["correct_answers"],
-                    "incorrect_answers": session["incorrect_answers"],
-                    "concepts_mastered": session["learned_concepts"],
+                    "correct_answers":   result["correct_answers"],
+                    "incorrect_answers": result["incorrect_answers"],
+                    "concepts_mastered": learned_concepts,
                 },
                 "is_correct":  is_correct,
                 "explanation": explanation_text,
             })
 
-        # get next question (instant — already pre-generated)
+        # get next question (instant — already pre-generated; if the student caught
+        # up with generation it is null and the client long-polls /api/next-question)
         try:
-            next_question = get_next_progressive_question(session_id)
-            if not next_question:
-                session["completed"] = True
-                logger.info("Session completed: %s", session_id)
-                return jsonify({
-                    "session_complete": True,
-                    "final_score":       session["score"],
-                    "total_questions":   len(queue.completed_questions),
-                    "learned_concepts":  len(session["learned_concepts"]),
-                    "is_correct":        is_correct,
-                    "explanation":       explanation_text,
-                })
+            next_question = build_question_payload(session_id, queue, score, result["loading"])
 
             return jsonify({
                 "is_correct":       is_correct,
@@ -1238,7 +4627,7 @@ def submit_progressive_answer():
                 "next_question":    next_question,
                 "session_complete": False,
                 "progress":         progress,
-                "score":            session["score"],
+                "score":            score,
             })
 
         except Exception as e:
@@ -1253,6 +4642,76 @@ def submit_progressive_answer():
         logger.error("Submit progressive answer error: %s", e)
         raise APIError(f"Failed to submit answer: {str(e)}", 500)
 
+@app.route('/api/next-question', methods=['POST'])
+def next_question_route():
+    """
+    Long-poll for the next question after the student caught up with background
+    generation. Answers as soon as questions are added; with session_complete once
+    nothing more is coming; or with next_question null on timeout, to be re-sent.
+    """
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        
+        if not session_id:
+            raise ValidationError('Session ID is required')
+        if not check_rate_limit(client_address(), 'next_question'):
+            raise APIError('Rate limit exceeded. Please slow down.', 429)
+        
+        current_index = load_session(session_id, ['current_index'])['current_index']
+        ensure_next_batch(session_id)  # Re-claims a batch whose generation stalled past its claim timeout
+        fields = wait_for_next_question(session_id, current_index)
+        if fields is None:
+            return jsonify({'session_id': session_id, 'next_question': None, 'session_complete': False})
+        
+        queue = fields['queue']
+        loading = generation_outstanding(fields, time.time())
+        next_question = build_question_payload(session_id, queue, fields['score'], loading)
+        if next_question:
+            return jsonify({
+                'session_id': session_id,
+                'next_question': next_question,
+                'session_complete': False,
+                'progress': queue.get_progress(loading),
+                'score': fields['score']
+            })
+        
+        # Generation owes the session nothing more: it is complete
+        def finish(session):
+            if len(session['main_questions']) > session['current_index'] or generation_outstanding(session, time.time()):
+                return {}  # Questions arrived meanwhile
+            return {'completed': True}
+        
+        changes = session_store.transaction(session_id, ['main_questions', 'current_index'] + GENERATION_FIELDS, finish)
+        if changes is None:
+            raise APIError("Session not found", 404)
+        if not changes:
+            return jsonify({'session_id': session_id, 'next_question': None, 'session_complete': False})
+        
+        logger.info("Session completed: %s", session_id)
+        session_work.cancel(session_id)
+        session = load_session(session_id, ['score', 'correct_answers', 'incorrect_answers', 'learned_concepts'])
+        return jsonify({
+            'session_id': session_id,
+            'session_complete': True,
+            'final_score': session['score'],
+            'total_questions': queue.current_index,
+            'learned_concepts': len(session['learned_concepts']),
+            'summary': {
+                'correct_answers': session['correct_answers'],
+                'incorrect_answers': session['incorrect_answers'],
+                'concepts_mastered': session['learned_concepts']
+            }
+        })
+        
+    except ValidationError as e:
+        raise e
+    except APIError as e:
+        raise e
+    except Exception as e:
+        logger.error(f"Next question error: {e}")
+        raise APIError(f'Failed to get next question: {str(e)}', 500)
+
 @app.route('/api/get-session-progress', methods=['POST'])
 def get_session_progress():
     try:
@@ -1262,21 +4721,26 @@ def get_session_progress():
         if not session_id:
             raise ValidationError('Session ID is required')
         
-        if session_id not in sessions:
-            raise APIError('Session not found', 404)
-        
-        session = sessions[session_id]
-        queue = session['question_queue']
+        session = load_session(session_id, [
+            'main_questions', 'current_index', 'score', 'learned_concepts', 'study_plan',
+            'correct_answers', 'incorrect_answers', 'completed', 'token_usage'
+        ] + GENERATION_FIELDS)
+        queue = QuestionQueue.restore(session['main_questions'], session['current_index'])
         
         return jsonify({
             'session_id': session_id,
-            'progress': queue.get_progress(),
+            'progress': queue.get_progress(generation_outstanding(session, time.time())),
             'score': session['score'],
             'learned_concepts': len(session['learned_concepts']),
             'total_concepts': len(session['study_plan']['learning_progression']),
             'correct_answers': session['correct_answers'],
             'incorrect_answers': session['incorrect_answers'],
-            'completed': session['completed']
+            'completed': session['completed'],
+            'token_usage': {
+                'by_call_type': session['token_usage'] or {},
+                'total_tokens': total_tokens(session['token_usage']),
+                'budget': Config.SESSION_TOKEN_BUDGET
+            }
         })
         
     except ValidationError as e:
@@ -1287,6 +4751,30 @@ def get_session_progress():
         logger.error(f"Get session progress error: {e}")
         raise APIError(f'Failed to get session progress: {str(e)}', 500)
 
+@app.route('/api/end-session', methods=['POST'])
+def end_session():
+    """Student left: stop the session's background generation and drop its state"""
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        
+        if not session_id:
+            raise ValidationError('Session ID is required')
+        
+        # Cancel first so no task writes to the session while it is being deleted
+        cancelled = session_work.cancel(session_id)
+        session_store.delete(session_id)
+        forget_session(session_id)
+        logger.info(f"Ended session {session_id} ({cancelled} background tasks cancelled)")
+        
+        return jsonify({'session_id': session_id, 'ended': True, 'cancelled_tasks': cancelled})
+        
+    except ValidationError as e:
+        raise e
+    except Exception as e:
+        logger.error(f"End session error: {e}")
+        raise APIError(f'Failed to end session: {str(e)}', 500)
+
 if __name__ == '__main__':
     # Ensure required environment variables are set
     if not Config.OPENAI_API_KEY:
@@ -1297,6 +4785,6 @@ if __name__ == '__main__':
     logger.info("Starting ALP3 Progressive Learning API v4.1...")
     logger.info("Model: %s", Config.OPENAI_MODEL)
     logger.info(f"Debug mode: {Config.DEBUG}")
-    logger.info(f"Active sessions will expire after {Config.SESSION_TIMEOUT_HOURS} hours")
+    logger.info(f"Idle sessions will expire after {Config.SESSION_TIMEOUT_HOURS} hours")
     
     app.run(host='0.0.0.0', port=8080, debug=Config.DEBUG)
\ No newline at end of file
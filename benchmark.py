@@ -0,0 +1,402 @@
+"""
+Offline benchmark for the ALP3 API.
+
+Starts a local stub of the OpenAI chat completions endpoint (configurable
+latency, error rate and response size), points Config.OPENAI_API_URL at it,
+serves the Flask app on a local port and drives load profiles of simulated
+students against /api/start-progressive-session and
+/api/submit-progressive-answer (long-polling /api/next-question when they
+catch up with generation).
+
+Reports sessions per second, time to first question (p50/p90/p99), answer
+latency and the queue-starvation rate (answers after which the student had
+no next question ready), and writes everything to JSON for comparing runs:
+
+    python benchmark.py --profile all --output bench.json
+    python benchmark.py --profile burst --baseline bench.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+PROFILES = {
+    "steady": "sessions arrive at a constant rate",
+    "burst": "all sessions arrive at once",
+    "ramp": "arrival rate grows linearly from zero to twice the target rate",
+}
+
+# Markers the stub uses to tell the app's prompts apart
+STUDY_PLAN_MARKER = "study plan"
+BATCH_MARKER = "BATCH:"
+MULTI_MASTERY_MARKER = "For EACH numbered concept"
+MASTERY_MARKER = "mastery questions that test the SAME CONCEPT"
+
+
+class StubLLM:
+    """Local chat completions endpoint returning well-formed ALP3 payloads"""
+
+    def __init__(self, latency, jitter, error_rate, pad_chars, concepts, seed):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.pad_chars = pad_chars
+        self.concepts = concepts
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.errors = 0
+        self.server = None
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                status, payload = stub.respond(body)
+                out = json.dumps(payload).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(out)))
+                    self.end_headers()
+                    self.wfile.write(out)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # The app cancelled the call, e.g. because the student ended the session
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="stub-llm", daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1/chat/completions"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+
+    def respond(self, body):
+        prompt = body["messages"][-1]["content"]
+        kind = self._kind(prompt)
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            delay = max(0.0, self.random.gauss(self.latency, self.jitter))
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        time.sleep(delay)
+        if failed:
+            return 500, {"error": {"message": "stub failure"}}
+        content = json.dumps(self._content(kind, prompt))
+        completion_tokens = len(content) // 4
+        return 200, {
+            "choices": [{"message": {"content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": completion_tokens,
+                      "total_tokens": len(prompt) // 4 + completion_tokens},
+        }
+
+    def _kind(self, prompt):
+        # Batch prompts are checked before the mastery ones: batch 3 is named "Mastery"
+        if STUDY_PLAN_MARKER in prompt:
+            return "study_plan"
+        if BATCH_MARKER in prompt:
+            return "batch"
+        if MULTI_MASTERY_MARKER in prompt:
+            return "mastery_batch"
+        if MASTERY_MARKER in prompt:
+            return "mastery"
+        return "batch"
+
+    def _content(self, kind, prompt):
+        if kind == "study_plan":
+            return {"topic": "Benchmark", "total_concepts": self.concepts, "learning_progression": [
+                {"concept_id": i, "concept_name": f"Concept {i}", "description": "Stub concept",
+                 "prerequisites": [i - 1] if i > 1 else [], "builds_to": [i + 1] if i < self.concepts else []}
+                for i in range(1, self.concepts + 1)]}
+        if kind == "mastery_batch":
+            count = prompt.count("Question the student got wrong")
+            return {"concepts": [{"concept_index": c, "questions": [self._question(i, True) for i in range(1, 6)]}
+                                 for c in range(1, count + 1)]}
+        if kind == "mastery":
+            return {"questions": [self._question(i, True) for i in range(1, 6)]}
+        return {"questions": [self._question(i, False) for i in range(1, 6)]}
+
+    def _question(self, i, mastery):
+        pad = "x" * self.pad_chars
+        question = {
+            "question_id": i, "concept_id": 1, "question": f"Stub question {i}? {pad}",
+            "options": {"A": f"Option A{i}", "B": f"Option B{i}", "C": f"Option C{i}", "D": f"Option D{i}"},
+            "correct_answer": "C",
+            "explanations": {"correct": f"Because C. {pad}", "A": "Not A.", "B": "Not B.", "C": "Yes, C.", "D": "Not D."},
+            "teaching_focus": f"Concept {i % self.concepts + 1}", "difficulty": "medium",
+        }
+        if mastery:
+            question["mastery_question_id"] = i
+        return question
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile; None for no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100 * len(ordered) + 0.5)))
+    return round(ordered[min(rank, len(ordered)) - 1], 4)
+
+
+def summarize(values):
+    return {"count": len(values), "p50": percentile(values, 50), "p90": percentile(values, 90),
+            "p99": percentile(values, 99), "max": round(max(values), 4) if values else None}
+
+
+def arrival_offsets(profile, sessions, rate):
+    """Seconds after the start at which each simulated student arrives"""
+    if profile == "burst":
+        return [0.0] * sessions
+    duration = sessions / rate
+    if profile == "ramp":
+        # Linearly growing rate: the i-th arrival falls where the cumulative count reaches i
+        return [duration * ((i / sessions) ** 0.5) for i in range(sessions)]
+    return [i / rate for i in range(sessions)]
+
+
+class Student:
+    """One simulated learner: starts a session and answers with think time"""
+
+    def __init__(self, base_url, client_ip, topic, args, peek_answer, rng):
+        self.base_url = base_url
+        self.topic = topic
+        self.headers = {"X-Forwarded-For": client_ip}
+        self.args = args
+        self.peek_answer = peek_answer
+        self.rng = rng
+        self.http = requests.Session()
+        self.result = {"ttfq": None, "answers": [], "starved": 0, "starved_wait": [], "completed": False,
+                       "error": None}
+
+    def post(self, path, payload):
+        response = self.http.post(f"{self.base_url}{path}", json=payload, headers=self.headers,
+                                  timeout=self.args.request_timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def run(self):
+        try:
+            started = time.perf_counter()
+            question = self.post("/api/start-progressive-session", {"type": "topic", "topic": self.topic})
+            self.result["ttfq"] = time.perf_counter() - started
+            session_id = question["session_id"]
+
+            for _ in range(self.args.answers):
+                time.sleep(max(0.0, self.rng.gauss(self.args.think_time, self.args.think_time / 4)))
+                answer = self.peek_answer(session_id, question["question_id"])
+                if self.rng.random() >= self.args.accuracy:
+                    answer = next(option for option in "ABCD" if option != answer)
+
+                started = time.perf_counter()
+                result = self.post("/api/submit-progressive-answer", {
+                    "session_id": session_id, "question_id": question["question_id"], "selected_answer": answer})
+                self.result["answers"].append(time.perf_counter() - started)
+                if result.get("session_complete"):
+                    self.result["completed"] = True
+                    return self.result
+
+                question = result.get("next_question")
+                if question is None:
+                    # Caught up with generation: long-poll until the next question exists
+                    self.result["starved"] += 1
+                    waited = time.perf_counter()
+                    while question is None:
+                        result = self.post("/api/next-question", {"session_id": session_id})
+                        if result.get("session_complete"):
+                            self.result["completed"] = True
+                            self.result["starved_wait"].append(time.perf_counter() - waited)
+                            return self.result
+                        question = result.get("next_question")
+                    self.result["starved_wait"].append(time.perf_counter() - waited)
+
+            self.post("/api/end-session", {"session_id": session_id})
+        except Exception as e:
+            self.result["error"] = f"{type(e).__name__}: {e}"
+        return self.result
+
+
+def run_profile(profile, args, base_url, stub, app_module, next_ip):
+    rng = random.Random(f"{args.seed}:{profile}")
+    offsets = arrival_offsets(profile, args.sessions, args.rate)
+
+    def peek_answer(session_id, question_id):
+        # The answer key never leaves the server; the harness shares its process
+        field = app_module.question_field(question_id)
+        question = app_module.session_store.load(session_id, [field])[field]
+        return app_module.displayed_option(question, question["correct_answer"])
+
+    topics = args.topics or len(offsets)
+    students = [Student(base_url, next_ip(), f"{args.topic} {profile} {i % topics}", args, peek_answer,
+                        random.Random(rng.random()))
+                for i in range(len(offsets))]
+    calls_before = dict(stub.calls)
+    errors_before = stub.errors
+    started = time.perf_counter()
+
+    def arrive(student, offset):
+        time.sleep(max(0.0, started + offset - time.perf_counter()))
+        return student.run()
+
+    with ThreadPoolExecutor(max_workers=len(students)) as pool:
+        results = list(pool.map(arrive, students, offsets))
+    wall = time.perf_counter() - started
+
+    ttfq = [r["ttfq"] for r in results if r["ttfq"] is not None]
+    answers = [latency for r in results for latency in r["answers"]]
+    starved = sum(r["starved"] for r in results)
+    errors = [r["error"] for r in results if r["error"]]
+    last_arrival = offsets[-1] if offsets else 0.0
+    health = requests.get(f"{base_url}/api/health", timeout=args.request_timeout).json()
+    return {
+        "profile": profile,
+        "description": PROFILES[profile],
+        "wall_seconds": round(wall, 3),
+        "sessions": len(results),
+        "sessions_started": len(ttfq),
+        "sessions_per_second": round(len(ttfq) / max(last_arrival + max(ttfq, default=0.0), 1e-9), 3),
+        "time_to_first_question": summarize(ttfq),
+        "answer_latency": summarize(answers),
+        "answers": len(answers),
+        "starved_answers": starved,
+        "starvation_rate": round(starved / len(answers), 4) if answers else None,
+        "starvation_wait": summarize([w for r in results for w in r["starved_wait"]]),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "llm_calls": {kind: count - calls_before.get(kind, 0) for kind, count in stub.calls.items()},
+        "llm_errors": stub.errors - errors_before,
+        "scheduler": health.get("llm_scheduler"),
+        "single_flight": health.get("single_flight"),
+    }
+
+
+REGRESSION_KEYS = [
+    ("sessions_per_second", None, True),
+    ("time_to_first_question", "p50", False),
+    ("time_to_first_question", "p99", False),
+    ("answer_latency", "p99", False),
+    ("starvation_rate", None, False),
+]
+
+
+def compare(results, baseline_path):
+    """Print the change of the headline numbers against an earlier run"""
+    with open(baseline_path) as f:
+        baseline = {entry["profile"]: entry for entry in json.load(f)["results"]}
+    for entry in results:
+        before = baseline.get(entry["profile"])
+        if before is None:
+            continue
+        print(f"\n{entry['profile']} vs baseline:")
+        for key, sub, higher_is_better in REGRESSION_KEYS:
+            old = before[key][sub] if sub else before[key]
+            new = entry[key][sub] if sub else entry[key]
+            name = f"{key}.{sub}" if sub else key
+            if old in (None, 0) or new is None:
+                print(f"  {name:32} {old} -> {new}")
+                continue
+            change = (new - old) / old * 100
+            worse = change < 0 if higher_is_better else change > 0
+            print(f"  {name:32} {old} -> {new} ({change:+.1f}%{' worse' if worse and abs(change) >= 5 else ''})")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", choices=list(PROFILES) + ["all"], default="steady")
+    parser.add_argument("--sessions", type=int, default=20, help="simulated students per profile")
+    parser.add_argument("--rate", type=float, default=5.0, help="target session arrivals per second")
+    parser.add_argument("--answers", type=int, default=10, help="answers per student before leaving")
+    parser.add_argument("--think-time", type=float, default=1.0, help="mean seconds a student takes per answer")
+    parser.add_argument("--accuracy", type=float, default=0.8, help="share of correct answers")
+    parser.add_argument("--topic", default="Photosynthesis")
+    parser.add_argument("--topics", type=int, default=0,
+                        help="distinct topics shared by the students (default: one per student, no coalescing)")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="mean stub completion latency in seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.1, help="standard deviation of the stub latency")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="share of stub calls answered with HTTP 500")
+    parser.add_argument("--response-pad", type=int, default=200, help="extra characters per question to grow responses")
+    parser.add_argument("--concepts", type=int, default=5, help="concepts in the stub study plan")
+    parser.add_argument("--request-timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cache", action="store_true", help="keep the generation cache on (off by default)")
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--baseline", help="earlier results JSON to compare against")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # Configure the app before importing it: Config reads the environment at import time
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ["PREFETCH_ENABLED"] = "false"
+    os.environ["SESSION_STORE"] = os.environ.get("SESSION_STORE", "memory")
+    if not args.cache:
+        os.environ["CACHE_BACKEND"] = "none"  # Otherwise every session after the first is a cache hit
+    import logging
+    logging.disable(logging.WARNING)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as app_module
+    from werkzeug.serving import make_server
+
+    stub = StubLLM(args.llm_latency, args.llm_jitter, args.llm_error_rate, args.response_pad,
+                   args.concepts, args.seed)
+    app_module.Config.OPENAI_API_URL = stub.start()
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="benchmark-app", daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    # Each student gets its own address so the per-IP session rate limit does not apply
+    ip_counter = iter(range(1, 1 << 24))
+
+    def next_ip():
+        n = next(ip_counter)
+        return f"10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}"
+
+    profiles = list(PROFILES) if args.profile == "all" else [args.profile]
+    results = []
+    try:
+        for profile in profiles:
+            print(f"Running {profile}: {args.sessions} sessions at {args.rate}/s ...", flush=True)
+            entry = run_profile(profile, args, base_url, stub, app_module, next_ip)
+            results.append(entry)
+            ttfq = entry["time_to_first_question"]
+            print(f"  {entry['sessions_per_second']} sessions/s, TTFQ p50 {ttfq['p50']}s p99 {ttfq['p99']}s, "
+                  f"starvation {entry['starvation_rate']}, errors {entry['errors']}")
+    finally:
+        server.shutdown()
+        stub.stop()
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,7 @@ class ALP3State {
         this.conceptsLearned = 0;
         this.sessionComplete = false;
         this.isLoading = false;
+        this.nextQuestionPending = null;
     }
 
     reset() {
@@ -37,6 +38,7 @@ class ALP3State {
         this.conceptsLearned = 0;
         this.sessionComplete = false;
         this.isLoading = false;
+        this.nextQuestionPending = null;
     }
 }
 
@@ -314,7 +316,73 @@ class APIClient {
         }
     }
 
-    static async submitAnswer(sessionId, selectedAnswer, currentQuestion) {
+    static async streamProgressiveSession(topic) {
+        // Resolves with the first question as soon as it is streamed. The rest of
+        // the stream is drained in the background so the server finishes batch 0.
+        const response = await fetch(`${API_BASE_URL}/stream-progressive-session`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({
+                type: 'topic',
+                topic: topic
+            })
+        });
+
+        if (!response.ok || !response.body) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) {
+                throw new Error('Stream ended before the first question');
+            }
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const event = APIClient.parseServerEvent(buffer.slice(0, boundary));
+                buffer = buffer.slice(boundary + 2);
+                if (event.name === 'error') {
+                    throw new Error(event.data.error);
+                }
+                if (event.name === 'question') {
+                    APIClient.drainStream(reader);
+                    return event.data;
+                }
+            }
+        }
+    }
+
+    static parseServerEvent(message) {
+        let name = 'message';
+        const data = [];
+        for (const line of message.split('\n')) {
+            if (line.startsWith('event:')) {
+                name = line.slice(6).trim();
+            } else if (line.startsWith('data:')) {
+                data.push(line.slice(5).trim());
+            }
+        }
+        return { name: name, data: data.length ? JSON.parse(data.join('\n')) : null };
+    }
+
+    static async drainStream(reader) {
+        try {
+            while (!(await reader.read()).done) {
+                // Later questions are served by submit-progressive-answer
+            }
+        } catch (error) {
+            console.error('Session stream error:', error);
+        }
+    }
+
+    static async submitAnswer(sessionId, selectedAnswer, questionId) {
         try {
             const response = await fetch(`${API_BASE_URL}/submit-progressive-answer`, {
                 method: 'POST',
@@ -324,7 +392,7 @@ class APIClient {
                 body: JSON.stringify({
                     session_id: sessionId,
                     selected_answer: selectedAnswer,
-                    current_question: currentQuestion
+                    question_id: questionId
                 })
             });
 
@@ -338,6 +406,35 @@ class APIClient {
             throw error;
         }
     }
+
+    static async waitForNextQuestion(sessionId) {
+        try {
+            const response = await fetch(`${API_BASE_URL}/next-question`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({
+                    session_id: sessionId
+                })
+            });
+
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+
+            return await response.json();
+        } catch (error) {
+            console.error('Next question error:', error);
+            throw error;
+        }
+    }
+
+    static endSession(sessionId) {
+        // sendBeacon survives page unload; the server cancels the session's background work
+        const body = new Blob([JSON.stringify({ session_id: sessionId })], { type: 'application/json' });
+        navigator.sendBeacon(`${API_BASE_URL}/end-session`, body);
+    }
 }
 
 // Event Handlers
@@ -354,7 +451,13 @@ async function startTopicSession() {
         state.isLoading = true;
         UIManager.showLoading('Creating your progressive learning plan...');
 
-        const questionData = await APIClient.startProgressiveSession('topic', { topic });
+        let questionData;
+        try {
+            questionData = await APIClient.streamProgressiveSession(topic);
+        } catch (error) {
+            console.warn('Streaming start failed, using the blocking endpoint:', error);
+            questionData = await APIClient.startProgressiveSession('topic', { topic });
+        }
         
         state.sessionId = questionData.session_id;
         state.currentQuestion = questionData;
@@ -381,7 +484,7 @@ async function submitAnswer() {
         const resultData = await APIClient.submitAnswer(
             state.sessionId,
             state.selectedAnswer,
-            state.currentQuestion
+            state.currentQuestion.question_id
         );
 
         UIManager.displayResults(resultData);
@@ -389,6 +492,10 @@ async function submitAnswer() {
         // Store next question if available
         if (resultData.next_question) {
             state.currentQuestion = resultData.next_question;
+        } else if (!resultData.session_complete) {
+            // Caught up with question generation: wait for the server to push the next one
+            state.currentQuestion = null;
+            state.nextQuestionPending = awaitNextQuestion(state.sessionId);
         }
 
     } catch (error) {
@@ -400,13 +507,51 @@ async function submitAnswer() {
     }
 }
 
-function continueToNextQuestion() {
+async function awaitNextQuestion(sessionId) {
+    // Each request is held open until questions are added; null after a timeout means ask again
+    while (true) {
+        const data = await APIClient.waitForNextQuestion(sessionId);
+        if (data.next_question || data.session_complete) {
+            return data;
+        }
+    }
+}
+
+async function continueToNextQuestion() {
+    if (state.nextQuestionPending) {
+        const nextBtn = document.getElementById('next-btn');
+        nextBtn.disabled = true;
+        nextBtn.textContent = 'Preparing next question...';
+        let data;
+        try {
+            data = await state.nextQuestionPending;
+        } catch (error) {
+            // Keep waiting in the background so "Continue" can be retried
+            state.nextQuestionPending = awaitNextQuestion(state.sessionId);
+            UIManager.showError(`Failed to get next question: ${error.message}`);
+            return;
+        } finally {
+            nextBtn.disabled = false;
+            nextBtn.textContent = 'Continue Learning →';
+        }
+
+        state.nextQuestionPending = null;
+        if (data.session_complete) {
+            UIManager.showSessionComplete(data);
+            return;
+        }
+        state.currentQuestion = data.next_question;
+    }
+
     if (state.currentQuestion && !state.sessionComplete) {
         UIManager.displayQuestion(state.currentQuestion);
     }
 }
 
 function restartSession() {
+    if (state.sessionId && !state.sessionComplete) {
+        APIClient.endSession(state.sessionId);
+    }
     state.reset();
     UIManager.showScreen('start-screen');
     
@@ -423,6 +568,13 @@ document.addEventListener('DOMContentLoaded', function() {
     document.getElementById('next-btn').addEventListener('click', continueToNextQuestion);
     document.getElementById('restart-btn').addEventListener('click', restartSession);
 
+    // Leaving the page abandons the session
+    window.addEventListener('pagehide', function() {
+        if (state.sessionId && !state.sessionComplete) {
+            APIClient.endSession(state.sessionId);
+        }
+    });
+
     // Enter key support for topic input
     document.getElementById('topic-input').addEventListener('keypress', function(e) {
         if (e.key === 'Enter') {